@@ -1,5 +1,9 @@
 import logging
+import concurrent.futures
+import sqlite3
+import threading
 from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter
 from colorama import Fore, Style, init
 import sys
 import os
@@ -14,123 +18,297 @@ logging.basicConfig(
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 
-def create_upload_files(stockready_file='StockReady.xlsx', output_dir='uploads'):
+# Заголовок файла загрузки
+UPLOAD_HEADER = "sku\tprice\tminimum-seller-allowed-price\tmaximum-seller-allowed-price\tquantity\thandling-time\tfulfillment-channel\n"
+HANDLING_TIME = '3'  # Фиксированное значение handling-time
+UPLOAD_BATCH = 10000  # Столько строк собирается перед одной записью в файл
+UPLOAD_BUFFER = 1 << 20  # Размер буфера файла загрузки, байт
+UPLOAD_WORKERS = 8  # Сколько файлов магазинов пишется параллельно
+SNAPSHOT_FILE = 'upload_snapshot.sqlite'  # Последние выгруженные quantity для --delta
+
+def stock_to_quantity(stock):
     """
-    Создает текстовые файлы на основе данных из StockReady.xlsx.
+    Преобразование stock в quantity: 0 -> '0', любое другое число -> '1',
+    пусто или не число (например, "Error") -> ''.
+    """
+    if isinstance(stock, (int, float)):
+        return '0' if stock == 0 else '1'
+    if stock is None:
+        return ""
+    try:
+        stock_num = int(stock)
+        return '0' if stock_num == 0 else '1'
+    except ValueError:
+        return ""
 
-    :param stockready_file: Имя исходного Excel-файла.
+def sanitize_store_name(store_name, idx):
+    """
+    Название магазина без пробелов или Store_{idx}, если названия нет.
+    """
+    return ''.join(store_name.split()) if isinstance(store_name, str) else f"Store_{idx}"
+
+def upload_file_name(store_name, idx):
+    """
+    Имя файла загрузки магазина.
+    """
+    return f"upload_{sanitize_store_name(store_name, idx)}.txt"
+
+class UploadSnapshot:
+    """
+    Последние выгруженные quantity по магазину и SKU в локальном файле SQLite.
+
+    В режиме delta в файл загрузки попадают только SKU, у которых quantity изменился
+    (строки без quantity пропускаются). Полная выгрузка делается при первом запуске
+    магазина и раз в full_every запусков, она заменяет снимок магазина целиком.
+    Без delta каждая выгрузка полная, но тоже записывается в снимок, чтобы
+    следующий запуск с delta сравнивал с тем, что выгружено последним.
+    Снимок обновляется только после успешной записи файла (commit).
+    """
+
+    def __init__(self, path=SNAPSHOT_FILE, full_every=0, delta=True):
+        self.full_every = full_every
+        self.delta = delta
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS snapshot ("
+            "store TEXT NOT NULL, sku TEXT NOT NULL, quantity INTEGER NOT NULL, "
+            "PRIMARY KEY (store, sku)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stores (store TEXT PRIMARY KEY, delta_runs INTEGER NOT NULL)"
+        )
+
+    def full_due(self, store):
+        """
+        Нужна ли магазину полная выгрузка в этом запуске.
+        """
+        if not self.delta:
+            return True
+        with self._lock:
+            row = self._conn.execute("SELECT delta_runs FROM stores WHERE store = ?", (store,)).fetchone()
+        return row is None or (self.full_every > 0 and row[0] + 1 >= self.full_every)
+
+    def rows(self, store, entries, full):
+        """
+        Строки (sku, quantity) для файла загрузки: при full — все, иначе только изменившиеся.
+        Изменения запоминаются до commit(store).
+        """
+        with self._lock:
+            previous = {} if full else dict(
+                self._conn.execute("SELECT sku, quantity FROM snapshot WHERE store = ?", (store,))
+            )
+        changed = {}
+        self._pending[store] = (full, changed)
+        for sku, stock in entries:
+            if not sku:
+                continue
+            quantity = stock_to_quantity(stock)
+            if quantity:
+                key = str(sku)
+                if full or previous.get(key) != int(quantity):
+                    changed[key] = int(quantity)
+                    yield sku, quantity
+            elif full:
+                yield sku, quantity
+
+    def commit(self, store):
+        """
+        Запись изменений магазина в снимок после успешной выгрузки.
+        """
+        full, changed = self._pending.pop(store)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            if full:
+                self._conn.execute("DELETE FROM snapshot WHERE store = ?", (store,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO snapshot (store, sku, quantity) VALUES (?, ?, ?)",
+                ((store, sku, quantity) for sku, quantity in changed.items())
+            )
+            self._conn.execute(
+                "INSERT INTO stores (store, delta_runs) VALUES (?, 0) "
+                "ON CONFLICT (store) DO UPDATE SET delta_runs = CASE WHEN ? THEN 0 ELSE delta_runs + 1 END",
+                (store, full)
+            )
+            self._conn.execute("COMMIT")
+        return len(changed)
+
+    def discard(self, store):
+        self._pending.pop(store, None)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def open_upload_snapshot(path, delta, full_every=0):
+    """
+    Снимок для выгрузки: с delta всегда, без delta — только если файл снимка уже есть
+    (полная выгрузка обновляет его, иначе следующий delta сравнит с устаревшими quantity).
+    """
+    if delta or os.path.exists(path):
+        return UploadSnapshot(path, full_every, delta)
+    return None
+
+def write_upload_lines(f, entries):
+    """
+    Запись заголовка и строк загрузки в открытый текстовый поток пачками по UPLOAD_BATCH строк.
+    Возвращает число записанных строк.
+    """
+    f.write(UPLOAD_HEADER)
+    written = 0
+    batch = []
+    for sku, stock in entries:
+        # Пропуск строк с пустыми SKU
+        if not sku:
+            continue
+        # Пустые поля: price, minimum-seller-allowed-price, maximum-seller-allowed-price и fulfillment-channel
+        batch.append(f"{sku}\t\t\t\t{stock_to_quantity(stock)}\t{HANDLING_TIME}\t\n")
+        if len(batch) >= UPLOAD_BATCH:
+            f.write(''.join(batch))
+            written += len(batch)
+            batch.clear()
+    f.write(''.join(batch))
+    return written + len(batch)
+
+def write_upload_file(store_name, entries, output_dir='uploads', idx=1, snapshot=None):
+    """
+    Запись файла загрузки одного магазина.
+
+    :param store_name: Название магазина (определяет имя файла).
+    :param entries: Пары (sku, stock) в порядке строк; строки с пустым SKU пропускаются.
     :param output_dir: Папка для сохранения текстовых файлов.
+    :param idx: Номер магазина для имени по умолчанию.
+    :param snapshot: UploadSnapshot для режима delta (только изменившиеся SKU).
+    :return: Путь к файлу или None при ошибке записи.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_filename = upload_file_name(store_name, idx)
+    output_path = os.path.join(output_dir, output_filename)
+    store = sanitize_store_name(store_name, idx)
+    full = snapshot is None or snapshot.full_due(store)
+    if snapshot is not None:
+        entries = snapshot.rows(store, entries, full)
+    try:
+        with open(output_path, 'w', encoding='utf-8', buffering=UPLOAD_BUFFER) as f:
+            written = write_upload_lines(f, entries)
+    except Exception as e:
+        logging.error(f"{Fore.RED}Error writing to '{output_filename}': {e}{Style.RESET_ALL}")
+        if snapshot is not None:
+            snapshot.discard(store)
+        return None
+    if snapshot is not None:
+        snapshot.commit(store)
+    if snapshot is not None and snapshot.delta:
+        kind = "full refresh" if full else "changed only"
+        logging.info(f"{Fore.GREEN}Created '{output_filename}' with {written} entries ({kind}).{Style.RESET_ALL}")
+    else:
+        logging.info(f"{Fore.GREEN}Created '{output_filename}' with {written} entries.{Style.RESET_ALL}")
+    return output_path
+
+def read_stock_ready(stockready_file='StockReady.xlsx'):
+    """
+    Чтение StockReady.xlsx за один проход iter_rows в режиме read_only.
+
+    Возвращает список магазинов (idx, store_name, entries), где entries — пары (sku, stock)
+    с третьей строки, или None, если файл не удалось прочитать.
     """
     try:
         # Загрузка Excel-файла
-        workbook = load_workbook(filename=stockready_file)
-        sheet = workbook.active
+        workbook = load_workbook(filename=stockready_file, read_only=True)
         logging.info(f"{Fore.GREEN}Loaded '{stockready_file}' successfully.{Style.RESET_ALL}")
     except Exception as e:
         logging.error(f"{Fore.RED}Error loading Excel file '{stockready_file}': {e}{Style.RESET_ALL}")
-        return
-
-    # Определение заголовков
-    headers = {
-        'SKU': 'SKU',
-        'ParserLink': 'ParserLink',
-        'Stock': 'Stock'
-    }
-
-    # Поиск всех колонок, начинающихся с 'SKU'
-    sku_columns = []
-    max_column = sheet.max_column
-    for col in range(1, max_column + 1):
-        cell_value = sheet.cell(row=2, column=col).value  # Заголовки находятся во второй строке
-        if cell_value == headers['SKU']:
-            sku_columns.append(col)
-
-    if not sku_columns:
-        logging.error(f"{Fore.RED}No 'SKU' columns found in '{stockready_file}'. Exiting.{Style.RESET_ALL}")
-        return
+        return None
 
-    logging.info(f"{Fore.GREEN}Found {len(sku_columns)} account(s) in '{stockready_file}'.{Style.RESET_ALL}")
+    names = ()
+    accounts = []
+    try:
+        for row, values in enumerate(workbook.active.iter_rows(values_only=True), start=1):
+            if row == 1:
+                names = values
+            elif row == 2:
+                # Заголовки находятся во второй строке: все колонки 'SKU', Stock — через одну после SKU
+                max_column = len(values)
+                sku_columns = [col for col, value in enumerate(values) if value == 'SKU']
+                if not sku_columns:
+                    logging.error(f"{Fore.RED}No 'SKU' columns found in '{stockready_file}'. Exiting.{Style.RESET_ALL}")
+                    return []
+                logging.info(f"{Fore.GREEN}Found {len(sku_columns)} account(s) in '{stockready_file}'.{Style.RESET_ALL}")
+                for idx, sku_col in enumerate(sku_columns, start=1):
+                    if sku_col + 2 >= max_column:
+                        logging.warning(
+                            f"{Fore.YELLOW}Missing 'Stock' column for SKU column {sku_col + 1}. Skipping this account.{Style.RESET_ALL}")
+                        continue
+                    # Получение названия магазина из первой строки соответствующего столбца SKU
+                    store_name = names[sku_col] if sku_col < len(names) else None
+                    if not store_name:
+                        store_name = f"Store_{idx}"  # Если название не найдено, использовать дефолтное
+                        logging.warning(f"{Fore.YELLOW}Store name not found in cell {get_column_letter(sku_col + 1)}1. "
+                                        f"Using default name '{store_name}'.{Style.RESET_ALL}")
+                    else:
+                        logging.info(f"{Fore.BLUE}Store name for account {idx}: {store_name}{Style.RESET_ALL}")
+                    accounts.append((idx, store_name, sku_col, []))
+            else:
+                # Данные всех магазинов собираются за один проход по строкам
+                width = len(values)
+                for _, _, sku_col, entries in accounts:
+                    if sku_col < width:
+                        entries.append((values[sku_col], values[sku_col + 2] if sku_col + 2 < width else None))
+    finally:
+        workbook.close()
+    return [(idx, store_name, entries) for idx, store_name, _, entries in accounts]
 
-    # Создание папки для выходных файлов, если не существует
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def select_stores(accounts, stores):
+    """
+    Отбор магазинов по названию (с пробелами или без) для --store.
+    """
+    if not stores:
+        return accounts
+    wanted = {''.join(str(name).split()) for name in stores}
+    selected = [account for account in accounts if ''.join(str(account[1]).split()) in wanted]
+    if len(selected) < len(wanted):
+        logging.warning(f"{Fore.YELLOW}Only {len(selected)} of {len(wanted)} requested stores found.{Style.RESET_ALL}")
+    return selected
 
-    # Проход по каждой колонке SKU и обработка соответствующих данных
-    for idx, sku_col in enumerate(sku_columns, start=1):
-        parser_link_col = sku_col + 1
-        stock_col = parser_link_col + 1
+def create_upload_files(stockready_file='StockReady.xlsx', output_dir='uploads', stores=None, stream=None,
+                        max_workers=UPLOAD_WORKERS, snapshot=None):
+    """
+    Создает текстовые файлы на основе данных из StockReady.xlsx.
 
-        # Проверка, что stock_col не превышает количество колонок
-        if stock_col > max_column:
-            logging.warning(
-                f"{Fore.YELLOW}Missing 'Stock' column for SKU column {sku_col}. Skipping this account.{Style.RESET_ALL}")
-            continue
+    :param stockready_file: Имя исходного Excel-файла.
+    :param output_dir: Папка для сохранения текстовых файлов.
+    :param stores: Названия магазинов, для которых нужны файлы (по умолчанию все).
+    :param stream: Текстовый поток, куда пишутся данные вместо файлов (например, sys.stdout).
+    :param max_workers: Сколько файлов магазинов пишется параллельно.
+    :param snapshot: UploadSnapshot для режима delta (только изменившиеся SKU).
+    """
+    accounts = read_stock_ready(stockready_file)
+    if not accounts:
+        return
+    accounts = select_stores(accounts, stores)
 
-        # Получение названия магазина из первой строки соответствующего столбца SKU
-        store_name_cell = f"{sheet.cell(row=1, column=sku_col).coordinate}"
-        store_name = sheet.cell(row=1, column=sku_col).value
-        if not store_name:
-            store_name = f"Store_{idx}"  # Если название не найдено, использовать дефолтное
-            logging.warning(f"{Fore.YELLOW}Store name not found in cell {store_name_cell}. Using default name '{store_name}'.{Style.RESET_ALL}")
-        else:
-            logging.info(f"{Fore.BLUE}Store name for account {idx}: {store_name}{Style.RESET_ALL}")
-
-        # Очистка названия магазина от пробелов для имени файла
-        sanitized_store_name = ''.join(store_name.split()) if isinstance(store_name, str) else f"Store_{idx}"
-
-        # Чтение данных из колонок
-        data = []
-        for row in range(3, sheet.max_row + 1):  # Начинаем с 3-й строки
-            sku = sheet.cell(row=row, column=sku_col).value
-            stock = sheet.cell(row=row, column=stock_col).value
-
-            # Пропуск строк с пустыми SKU
-            if not sku:
-                continue
+    if stream is not None:
+        # Потоковый режим: заголовок и строки каждого магазина подряд в один поток
+        for idx, store_name, entries in accounts:
+            store = sanitize_store_name(store_name, idx)
+            if snapshot is not None:
+                entries = snapshot.rows(store, entries, snapshot.full_due(store))
+            written = write_upload_lines(stream, entries)
+            if snapshot is not None:
+                snapshot.commit(store)
+            logging.info(f"{Fore.GREEN}Streamed {written} entries for '{store_name}'.{Style.RESET_ALL}")
+        stream.flush()
+        return
 
-            # Преобразование stock по правилам
-            if isinstance(stock, (int, float)):
-                quantity = '0' if stock == 0 else '1'
-            elif stock is None:
-                quantity = ""
-            else:
-                try:
-                    stock_num = int(stock)
-                    quantity = '0' if stock_num == 0 else '1'
-                except ValueError:
-                    quantity = ""
-
-            data.append({
-                'SKU': sku,
-                'quantity': quantity,
-                'handling_time': '3'  # Фиксированное значение
-            })
-
-        # Определение имени выходного файла
-        output_filename = f"upload_{sanitized_store_name}.txt"
-        output_path = os.path.join(output_dir, output_filename)
-
-        # Запись данных в текстовый файл
-        try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                # Запись заголовка во вторую строку
-                header_line = "sku\tprice\tminimum-seller-allowed-price\tmaximum-seller-allowed-price\tquantity\thandling-time\tfulfillment-channel\n"
-                f.write(header_line)
-
-                # Запись строк данных начиная с третьей строки
-                for entry in data:
-                    line = (
-                        f"{entry['SKU']}\t"  # SKU
-                        f"\t\t\t"             # Пустые поля: price, minimum-seller-allowed-price, maximum-seller-allowed-price
-                        f"{entry['quantity']}\t"  # quantity
-                        f"{entry['handling_time']}\t"  # handling-time
-                        f"\n"  # fulfillment-channel пустой
-                    )
-                    f.write(line)
-
-            logging.info(f"{Fore.GREEN}Created '{output_filename}' with {len(data)} entries.{Style.RESET_ALL}")
-        except Exception as e:
-            logging.error(f"{Fore.RED}Error writing to '{output_filename}': {e}{Style.RESET_ALL}")
+    # Файлы магазинов пишутся параллельно
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(accounts)))) as executor:
+        futures = [executor.submit(write_upload_file, store_name, entries, output_dir, idx, snapshot)
+                   for idx, store_name, entries in accounts]
+        for future in futures:
+            future.result()
 
     logging.info(f"{Fore.CYAN}All upload files have been created in the '{output_dir}' directory.{Style.RESET_ALL}")
 
@@ -141,7 +319,32 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate upload text files from StockReady.xlsx")
     parser.add_argument('--input', type=str, default='StockReady.xlsx', help='Path to the StockReady.xlsx file')
     parser.add_argument('--output_dir', type=str, default='uploads', help='Directory to save the upload text files')
+    parser.add_argument('--store', action='append', default=None,
+                        help='Only this store (repeat for several); spaces in the name are ignored')
+    parser.add_argument('--stdout', action='store_true',
+                        help='Write upload data to stdout instead of files (log goes to stderr)')
+    parser.add_argument('--workers', type=int, default=UPLOAD_WORKERS, help='Number of store files written in parallel')
+    parser.add_argument('--delta', action='store_true',
+                        help='Write only SKUs whose quantity changed since the last upload')
+    parser.add_argument('--full-every', type=int, default=0,
+                        help='With --delta, write a full file every N runs per store (0: only the first run)')
+    parser.add_argument('--snapshot', type=str, default=SNAPSHOT_FILE,
+                        help='SQLite file with the last uploaded quantity per store and SKU '
+                             '(updated by full writes too once it exists)')
 
     args = parser.parse_args()
 
-    create_upload_files(stockready_file=args.input, output_dir=args.output_dir)
+    stream = None
+    if args.stdout:
+        # stdout занят данными загрузки, поэтому лог переносится в stderr
+        logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[logging.StreamHandler(sys.stderr)], force=True)
+        sys.stdout.reconfigure(encoding='utf-8')
+        stream = sys.stdout
+
+    snapshot = open_upload_snapshot(args.snapshot, args.delta, args.full_every)
+    try:
+        create_upload_files(stockready_file=args.input, output_dir=args.output_dir, stores=args.store, stream=stream,
+                            max_workers=args.workers, snapshot=snapshot)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
@@ -0,0 +1,411 @@
+import argparse
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import select
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from colorama import Fore, Style, init
+from openpyxl import Workbook
+from openpyxl.utils import column_index_from_string
+
+try:
+    import resource  # Нет в Windows: пиковая память тогда не измеряется
+except ImportError:
+    resource = None
+
+# Инициализация colorama
+init(autoreset=True)
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+# Константы настройки
+DEFAULT_SIZES = [200, 1000]  # Число ссылок в сгенерированных Stock_All.xlsx
+DEFAULT_MODES = ['process_product', 'worker', 'main']
+DEFAULT_PROXIES = 4  # Сколько локальных прокси поднимать вместо proxies.txt
+PAGE_FILLER = b'<div class="s-item">' + b'x' * 480 + b'</div>'  # Блок для набивки страницы до нужного размера
+PAGE_ITEMS = 60  # Товаров на странице без _ipg, как на eBay
+
+class StandInEbayHandler(BaseHTTPRequestHandler):
+    """
+    Локальная замена eBay: синтетические страницы поиска с заголовком srp-controls__count-heading.
+
+    Настройки (задержка, размер страницы, доли ошибок, 429 и капчи) берутся из self.server.config.
+    Понимает и обычные запросы, и абсолютные адреса от прокси.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body=b'', headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        config = self.server.config
+        parts = urlsplit(self.path)
+        if parts.path.endswith('/robots.txt'):
+            self._send(200, b'User-agent: *\nDisallow: /sch/\n', [('Content-Type', 'text/plain')])
+            return
+        if 'captcha' in parts.path:
+            self._send(200, b'<html><body>Please verify yourself: captcha</body></html>', [('Content-Type', 'text/html')])
+            return
+
+        latency = config['latency'] + random.uniform(0, config['jitter'])
+        if latency:
+            time.sleep(latency)
+        roll = random.random()
+        if roll < config['error_rate']:
+            self._send(500)
+            return
+        roll -= config['error_rate']
+        if roll < config['throttle_rate']:
+            self._send(429, headers=[('Retry-After', '1')])
+            return
+        roll -= config['throttle_rate']
+        if roll < config['captcha_rate']:
+            self._send(302, headers=[('Location', '/splashui/captcha?ap=1')])
+            return
+
+        query = parse_qs(parts.query)
+        keyword = query.get('_nkw', [''])[0]
+        # Размер страницы пропорционален числу товаров на ней (_ipg)
+        items = query.get('_ipg', [''])[0]
+        page_size = config['page_size'] * int(items) // PAGE_ITEMS if items.isdigit() else config['page_size']
+        count = int(hashlib.md5(keyword.encode('utf-8')).hexdigest()[:6], 16) % 3
+        heading = (f'<h1 class="srp-controls__count-heading"><span class="BOLD">{count:,}</span> '
+                   f'results for <span class="BOLD">{keyword}</span></h1>').encode('utf-8')
+        head = b'<html><head><title>eBay</title></head><body><div class="srp-controls">' + heading + b'</div>'
+        filler_count = max(0, (page_size - len(head)) // len(PAGE_FILLER))
+        body = head + PAGE_FILLER * filler_count + b'</body></html>'
+        self._send(200, body, [('Content-Type', 'text/html; charset=utf-8')])
+
+class ForwardProxyHandler(BaseHTTPRequestHandler):
+    """
+    Локальный прямой прокси вместо записей proxies.txt.
+
+    Абсолютные http-адреса пересылаются с сохранением соединения, CONNECT открывает туннель.
+    Логин и пароль не проверяются. Переданные байты копятся в self.server.bytes.
+    Доля stall_rate запросов «зависает» ещё на stall секунд — медленный хвост прокси.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=10)
+        except OSError:
+            self.send_error(502)
+            return
+        self.send_response(200, 'Connection Established')
+        self.end_headers()
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, _ = select.select(sockets, [], [], 30)
+                if not readable:
+                    break
+                for sock in readable:
+                    data = sock.recv(64 * 1024)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+                    self.server.bytes += len(data)
+        finally:
+            upstream.close()
+            self.close_connection = True
+
+    def do_GET(self):
+        delay = self.server.latency
+        if self.server.stall_rate and random.random() < self.server.stall_rate:
+            delay += self.server.stall
+        if delay:
+            time.sleep(delay)
+        parts = urlsplit(self.path)
+        headers = {name: value for name, value in self.headers.items()
+                   if name.lower() not in ('proxy-authorization', 'proxy-connection')}
+        upstream = getattr(self, '_upstream', None)
+        if upstream is None or upstream.host != parts.hostname or upstream.port != parts.port:
+            upstream = self._upstream = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        try:
+            upstream.request('GET', path, headers=headers)
+            response = upstream.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self._upstream = None
+            self.send_error(502)
+            return
+        self.send_response(response.status)
+        for name, value in response.getheaders():
+            if name.lower() not in ('content-length', 'transfer-encoding', 'connection'):
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.bytes += len(body)
+
+def start_server(handler, **attributes):
+    """
+    Запуск ThreadingHTTPServer на свободном порту в фоновом потоке.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def generate_stock_all(path, size, base_url):
+    """
+    Stock_All.xlsx на size ссылок, поровну по парам столбцов mainQWEN.COLUMN_PAIRS.
+    """
+    import mainQWEN
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet")
+    width = column_index_from_string(mainQWEN.COLUMN_PAIRS[-1][1])
+    names_row = [None] * width
+    headers_row = [None] * width
+    for idx, (sku_col, parser_col) in enumerate(mainQWEN.COLUMN_PAIRS):
+        names_row[column_index_from_string(sku_col) - 1] = f"Bench Store {idx + 1}"
+        headers_row[column_index_from_string(sku_col) - 1] = "SKU"
+        headers_row[column_index_from_string(parser_col) - 1] = "ParserLink"
+    sheet.append(names_row)
+    sheet.append(headers_row)
+    rows = -(-size // len(mainQWEN.COLUMN_PAIRS))
+    for row in range(rows):
+        values = [None] * width
+        for idx, (sku_col, parser_col) in enumerate(mainQWEN.COLUMN_PAIRS):
+            if row * len(mainQWEN.COLUMN_PAIRS) + idx >= size:
+                break
+            sku = f"BENCH-{idx + 1}-{row + 3}"
+            values[column_index_from_string(sku_col) - 1] = sku
+            values[column_index_from_string(parser_col) - 1] = f"{base_url}/sch/i.html?_nkw=bench{idx + 1}x{row + 3}&SKU_{sku}"
+        sheet.append(values)
+    workbook.save(path)
+
+def read_trace(path):
+    """
+    Задержки и байты всех попыток из журнала запросов mainQWEN (--trace-log).
+    """
+    latencies = []
+    total_bytes = 0
+    statuses = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            latencies.append(record['latency'])
+            total_bytes += record['bytes']
+            statuses[record['status']] = statuses.get(record['status'], 0) + 1
+    return latencies, total_bytes, statuses
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В Linux ru_maxrss в килобайтах, в macOS — в байтах
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def init_fetch_state(mainQWEN, proxies, args):
+    """
+    Глобальное состояние mainQWEN, которое обычно готовит main(), для прямых вызовов worker().
+    """
+    mainQWEN.proxy_scheduler = mainQWEN.ProxyScheduler(proxies)
+    mainQWEN.session_pool = mainQWEN.SessionPool(mainQWEN.SESSIONS_PER_PROXY if proxies else mainQWEN.CONCURRENCY_MAX)
+    mainQWEN.concurrency = mainQWEN.ConcurrencyController(args.concurrency)
+    mainQWEN.rate_limiter = mainQWEN.ProxyRateLimiter(0)
+    mainQWEN.result_cache = None
+    mainQWEN.rewrite_urls = True
+    if args.hedge:
+        mainQWEN.hedge_policy = mainQWEN.HedgePolicy()
+        mainQWEN.hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * mainQWEN.CONCURRENCY_MAX)
+
+def run_scenario(args):
+    """
+    Один замер в отдельном процессе, чтобы пиковая память не копилась между замерами.
+    Печатает строку JSON с результатами. Рабочая папка замера удаляется после него.
+    """
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='stock_bench_')
+    os.chdir(workdir)
+    try:
+        report = measure_scenario(args, workdir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(report))
+
+def measure_scenario(args, workdir):
+    """
+    Замер одного режима в текущей папке workdir. Возвращает словарь с результатами.
+    """
+    # Сам mainQWEN лежит рядом с этим файлом
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import mainQWEN
+    logging.getLogger().setLevel(logging.WARNING)
+    mainQWEN.PROXY_CHECK_URL = f"{args.base_url}/robots.txt"
+
+    proxy_ports = [int(port) for port in args.proxy_ports.split(',') if port]
+    with open('proxies.txt', 'w', encoding='utf-8') as f:
+        for port in proxy_ports:
+            f.write(f"127.0.0.1:{port}:bench:bench\n")
+    generate_stock_all('Stock_All.xlsx', args.size, args.base_url)
+    trace_path = os.path.join(workdir, 'trace.jsonl')
+
+    start = time.perf_counter()
+    if args.mode == 'main':
+        argv = ['--no-cache', '--no-progress', '--no-upload', '--trace-log', trace_path,
+                '--proxy-check-cache', os.path.join(workdir, 'proxy_check.json'),
+                '--journal', os.path.join(workdir, 'journal.jsonl'),
+                '--engine', args.engine, '--concurrency', str(args.concurrency), '--proxy-rate', '0']
+        if args.hedge:
+            argv.append('--hedge')
+        mainQWEN.main(mainQWEN.parse_args(argv))
+        processed = args.size
+    else:
+        proxies = mainQWEN.load_proxies()
+        init_fetch_state(mainQWEN, proxies, args)
+        mainQWEN.trace_log = mainQWEN.TraceLog(trace_path)
+        _, links = mainQWEN.load_links('Stock_All.xlsx')
+        records = [(idx, record) for idx, urls in enumerate(links, start=1) for record in urls]
+        start = time.perf_counter()
+        if args.mode == 'worker':
+            for _ in mainQWEN.run_threaded((record for _, record in records), args.concurrency):
+                pass
+        else:
+            # process_product() по одной ссылке подряд: чистая стоимость запроса и разбора
+            proxy = proxies[0] if proxies else None
+            with mainQWEN.session_pool.session(proxy) as session:
+                for idx, record in records:
+                    request_start = time.perf_counter()
+                    result = mainQWEN.process_product(session, record.url)
+                    result.latency = time.perf_counter() - request_start
+                    mainQWEN.record_fetch(record.url, proxy, idx, 0, result)
+        processed = len(records)
+        mainQWEN.trace_log.close()
+    elapsed = time.perf_counter() - start
+
+    latencies, total_bytes, statuses = read_trace(trace_path)
+    latencies.sort()
+    report = {
+        'mode': args.mode,
+        'engine': args.engine,
+        'size': args.size,
+        'elapsed': round(elapsed, 3),
+        'urls_per_second': round(processed / elapsed, 1) if elapsed else None,
+        'p50': round(latencies[len(latencies) // 2], 4) if latencies else None,
+        'p99': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 4) if latencies else None,
+        'mean': round(statistics.mean(latencies), 4) if latencies else None,
+        'requests': len(latencies),
+        'bytes': total_bytes,
+        'peak_rss_mb': peak_rss_mb(),
+        'statuses': statuses,
+    }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the mainQWEN.py fetch path against a local stand-in eBay")
+    parser.add_argument('--sizes', type=str, default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Comma-separated numbers of URLs in the generated Stock_All.xlsx files')
+    parser.add_argument('--modes', type=str, default=','.join(DEFAULT_MODES),
+                        help='Comma-separated entry points to drive: process_product, worker, main')
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help='Fetch engine for the main mode')
+    parser.add_argument('--concurrency', type=int, default=40, help='Initial concurrency for worker and main modes')
+    parser.add_argument('--proxies', type=int, default=DEFAULT_PROXIES,
+                        help='Number of local forward proxies (0 connects directly)')
+    parser.add_argument('--proxy-latency', type=float, default=0.0, help='Extra seconds each proxy adds per request')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='Share of proxy requests that stall for --stall seconds')
+    parser.add_argument('--stall', type=float, default=3.0, help='Extra seconds a stalled proxy request takes')
+    parser.add_argument('--hedge', action='store_true', help='Run worker and main modes with hedged requests')
+    parser.add_argument('--latency', type=float, default=0.05, help='Base server latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Random extra server latency in seconds')
+    parser.add_argument('--page-size', type=int, default=120 * 1024, help='Approximate page size in bytes for 60 items (scaled by _ipg)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of HTTP 500 responses')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of HTTP 429 responses')
+    parser.add_argument('--captcha-rate', type=float, default=0.0, help='Share of redirects to a captcha page')
+    parser.add_argument('--output', type=str, default=None, help='Also write all results to this JSON file')
+    # Внутренние аргументы для дочернего процесса одного замера
+    parser.add_argument('--run-one', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--mode', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--proxy-ports', type=str, default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_scenario(args)
+        return
+
+    config = {
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'page_size': args.page_size,
+        'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate,
+        'captcha_rate': args.captcha_rate,
+    }
+    ebay = start_server(StandInEbayHandler, config=config)
+    base_url = f"http://127.0.0.1:{ebay.server_address[1]}"
+    proxies = [start_server(ForwardProxyHandler, latency=args.proxy_latency, stall_rate=args.stall_rate, stall=args.stall,
+                            bytes=0) for _ in range(args.proxies)]
+    proxy_ports = ','.join(str(proxy.server_address[1]) for proxy in proxies)
+    logging.info(f"{Fore.GREEN}Stand-in eBay at {base_url}, {len(proxies)} local proxies.{Style.RESET_ALL}")
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',') if size]:
+        for mode in [mode for mode in args.modes.split(',') if mode]:
+            command = [sys.executable, os.path.abspath(__file__), '--run-one', '--mode', mode, '--size', str(size),
+                       '--base-url', base_url, '--proxy-ports', proxy_ports, '--engine', args.engine,
+                       '--concurrency', str(args.concurrency)]
+            if args.hedge:
+                command.append('--hedge')
+            completed = subprocess.run(command, capture_output=True, text=True)
+            lines = completed.stdout.strip().splitlines()
+            try:
+                report = json.loads(lines[-1])
+            except (IndexError, ValueError):
+                logging.error(f"{Fore.RED}Scenario {mode} x {size} failed:\n{completed.stdout}{completed.stderr}{Style.RESET_ALL}")
+                continue
+            results.append(report)
+            logging.info(
+                f"{Fore.CYAN}{mode:<16} {size:>7} URLs | {report['urls_per_second']:>8} URLs/s "
+                f"| p50 {report['p50']}s p99 {report['p99']}s | {report['bytes'] / 1e6:.1f} MB "
+                f"| peak RSS {report['peak_rss_mb']} MB | {report['statuses']}{Style.RESET_ALL}"
+            )
+
+    proxy_bytes = sum(proxy.bytes for proxy in proxies)
+    if proxies:
+        logging.info(f"{Fore.GREEN}Bytes relayed by local proxies: {proxy_bytes / 1e6:.1f} MB{Style.RESET_ALL}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'config': config, 'results': results}, f, indent=1)
+        logging.info(f"{Fore.GREEN}Results written to '{args.output}'.{Style.RESET_ALL}")
+
+if __name__ == "__main__":
+    main()
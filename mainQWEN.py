@@ -1,25 +1,99 @@
 import requests
 import pandas as pd
+import numpy as np
 import concurrent.futures
+import asyncio
+import math
+import threading
+import queue
+import argparse
+import hashlib
+import json
+import os
 import re
+import sqlite3
 import sys
 import random
 import logging
 import time
-import subprocess  # Добавлено для запуска второго скрипта
-from datetime import datetime, timedelta
+import io
+from array import array
+from contextlib import contextmanager
+from datetime import timedelta
+from enum import Enum
+from html import unescape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, unquote
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from lxml import html
 from colorama import Fore, Style, init
+from collections import deque
 from openpyxl import load_workbook, Workbook
+from openpyxl.utils import column_index_from_string, get_column_letter
+from UploadFIleCreation import write_upload_file, write_upload_lines, sanitize_store_name, open_upload_snapshot, SNAPSHOT_FILE
+
+try:
+    import aiohttp  # Нужен только для асинхронного движка (--engine async)
+except ImportError:
+    aiohttp = None
 
 init(autoreset=True)
 
 # Константы настройки
 MAX_THREADS = 40
+INFLIGHT_PER_WORKER = 2  # Задач в работе на один поток: остальные ссылки ещё не взяты из итератора
 MAX_RETRIES = 2
 TIMEOUT = 5
+ASYNC_MAX_CONCURRENCY = 1000  # Максимум одновременных запросов в асинхронном движке
+ASYNC_PER_PROXY_LIMIT = 50  # Максимум открытых соединений через один прокси
+SESSIONS_PER_PROXY = 4  # Размер пула долгоживущих сессий на один прокси
+SESSION_IDLE_TIMEOUT = 300  # Через сколько секунд простоя сессия закрывается
+STREAM_CHUNK_SIZE = 16 * 1024  # Размер блока при потоковом чтении страницы (--fast-extract)
+CACHE_FILE = 'stock_cache.sqlite'  # Файл кэша результатов между запусками
+CACHE_TTL = 3600  # Сколько секунд результат из кэша считается свежим
+CACHE_MAX_ENTRIES = 500000  # Максимум записей в кэше, старые вытесняются
+JOURNAL_FILE = 'run_journal.jsonl'  # Журнал завершённых ссылок для --resume
+URL_HISTORY_FILE = 'url_history.sqlite'  # Последнее значение и частота изменений каждой ссылки между запусками
+MAX_STALENESS = 86400  # Ссылка, не проверявшаяся дольше стольких секунд, проверяется при любом бюджете
+UPLOAD_DIR = 'uploads'  # Папка для файлов загрузки
+HISTORY_DIR = 'run_history'  # Папка с историей запусков в Parquet (по файлу на запуск)
+HISTORY_TOP = 10  # Строк в каждой таблице отчёта --history-report
+STOCK_ALL_FILE = 'Stock_All.xlsx'  # Исходный файл со ссылками
+DAEMON_PORT = 8765  # Порт локального HTTP-сервера в режиме --daemon
+REFRESH_INTERVAL = 900  # Секунд от начала одного цикла перепроверки до следующего в режиме --daemon
+WATCH_INTERVAL = 5  # Как часто в режиме --daemon проверяется время изменения Stock_All.xlsx, секунд
+PROXY_EWMA_ALPHA = 0.2  # Вес нового замера в скользящих средних задержки и успешности прокси
+PROXY_BREAKER_THRESHOLD = 5  # Столько ошибок подряд выводят прокси из работы
+PROXY_BREAKER_COOLDOWN = 60  # Через сколько секунд прокси получает пробный запрос
+PROXY_BREAKER_MAX_COOLDOWN = 900  # Предел удвоения паузы после неудачных пробных запросов
+PROXY_CHECK_URL = "https://www.ebay.com/robots.txt"  # Небольшая страница для проверки прокси
+PROXY_CHECK_MARKER = b'user-agent'  # Должно встретиться в начале ответа PROXY_CHECK_URL
+PROXY_CHECK_BYTES = 1024  # Сколько первых байт ответа читать при проверке
+PROXY_CHECK_CACHE_FILE = 'proxy_check_cache.json'  # Результаты проверки прокси между запусками
+PROXY_CHECK_TTL = 1800  # Сколько секунд результат проверки прокси считается свежим
+PROXY_RATE = 10.0  # Запросов в секунду через один прокси (0 — без ограничения)
+PROXY_BURST = 20  # Сколько запросов подряд прокси может отправить без паузы
+CONCURRENCY_MIN = 4  # Нижняя граница числа одновременных запросов при адаптации
+CONCURRENCY_MAX = 200  # Верхняя граница числа одновременных запросов в потоковом движке
+CONCURRENCY_LATENCY_TARGET = 3.0  # Пока средняя задержка ниже, число запросов растёт
+CONCURRENCY_ERROR_RATE = 0.3  # Доля ошибок, при которой число запросов сокращается
+CONCURRENCY_DECREASE = 0.5  # Во сколько раз сокращается число запросов
+THROTTLE_STATUSES = (429, 503)  # Ответы eBay, означающие ограничение частоты запросов
+NOT_FOUND_STATUSES = (404, 410)  # Страницы больше нет, повтор бесполезен
+CAPTCHA_MARKER = b'captcha'  # Признак страницы с капчей, если заголовка с количеством нет
+ENDED_MARKERS = (b'this listing has ended', b'this listing was ended')  # Признаки завершённого объявления
+RETRY_BUDGET = 2  # Сколько раз ссылка с ошибкой сразу перезагружается через другой прокси
+RETRY_BACKOFF = 1.0  # Базовая пауза перед повтором в секундах, удваивается с каждой попыткой
+HEDGE_PERCENTILE = 95  # Запасной запрос уходит, если ответа нет дольше этого процентиля задержки (--hedge)
+HEDGE_BUDGET = 0.05  # Запасных запросов не больше этой доли от основных
+HEDGE_WINDOW = 500  # По скольким последним успешным запросам считается процентиль
+HEDGE_MIN_SAMPLES = 20  # До стольких замеров запасные запросы не отправляются
+METRICS_INTERVAL = 10  # Как часто (в секундах) файл метрик перезаписывается во время работы
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Границы гистограмм времени в секундах
+PROGRESS_INTERVAL = 0.5  # Как часто (в секундах) перерисовывается строка прогресса
+PROGRESS_WINDOW = 30  # За сколько последних секунд считается скорость для ETA
+PROXIES_FILE = 'proxies.txt'  # Файл с прокси по умолчанию
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
@@ -28,6 +102,22 @@ USER_AGENTS = [
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Safari/605.1.15",
 ]
 RESULTS_PATTERN = re.compile(r'(\d+(?:,\d+)*)\s+results?\b', re.IGNORECASE)
+# Байтовые шаблоны для потокового поиска заголовка с количеством результатов
+COUNT_HEADING_MARKER = b'srp-controls__count-heading'
+COUNT_HEADING_PATTERN = re.compile(
+    rb'<h1[^>]*\sclass=["\']srp-controls__count-heading["\'][^>]*>(.*?)</h1>',
+    re.DOTALL | re.IGNORECASE
+)
+TAG_PATTERN = re.compile(rb'<[^>]+>')
+# Параметры ссылок, которые не влияют на выдачу и отбрасываются при канонизации
+TRACKING_PARAMS = {'_trksid', '_trkparms', 'hash', 'mkevt', 'mkcid', 'mkrid', 'campid', 'customid', 'toolid'}
+TRACKING_PARAM_PREFIXES = ('SKU_',)  # Метки SKU, которые мы сами дописываем в ParserLink
+# Параметры вида, сортировки и листания: количество результатов в заголовке от них не зависит
+COUNT_NEUTRAL_PARAMS = {'_ipg', '_pgn', '_skc', '_sop', '_dmd', 'rt', '_from', '_odkw', '_osacat', '_ssn_dmd'}
+DEFAULT_PARAMS = {('_sacat', '0')}  # Значения по умолчанию, равные отсутствию параметра
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+SEARCH_PATH_MARKER = '/sch/'  # Переписываются только ссылки на страницы поиска
+REWRITE_PAGE_SIZE = 25  # Товаров на странице в переписанной ссылке (_ipg); на eBay по умолчанию 60
 
 # Настройка логирования
 logging.basicConfig(
@@ -47,9 +137,26 @@ COLUMN_PAIRS = [
     ('V', 'W'),
 ]
 
-# Глобальные переменные для хранения ссылок с ошибками и ошибок прокси
-failed_urls = []
-proxy_errors_count = {}
+# Планировщик прокси по их состоянию (создаётся в main)
+proxy_scheduler = None
+# Пул сессий, общий для проверки прокси, всех пар столбцов и перепроверки (создаётся в main)
+session_pool = None
+# Потоковое извлечение количества результатов с ранним закрытием соединения (--fast-extract)
+fast_extract = False
+# Кэш результатов (создаётся в main, None при --no-cache)
+result_cache = None
+# Ограничение частоты запросов через каждый прокси и адаптивное число одновременных запросов (создаются в main)
+rate_limiter = None
+concurrency = None
+# Сколько повторов через другой прокси получает ссылка с ошибкой (--retries)
+retry_budget = RETRY_BUDGET
+# Журнал каждого запроса (--trace-log, создаётся в main)
+trace_log = None
+# Загрузка переписанных ссылок с минимальной страницей (rewrite_url, отключается --no-rewrite)
+rewrite_urls = False
+# Запасные запросы (--hedge, создаются в main) и потоки под них в потоковом движке
+hedge_policy = None
+hedge_executor = None
 
 def setup_session(proxy=None):
     """
@@ -59,7 +166,11 @@ def setup_session(proxy=None):
     retries = Retry(
         total=MAX_RETRIES,
         backoff_factor=1,
-        status_forcelist=[500, 502, 503, 504]
+        # 503 означает ограничение частоты: повтор сразу только усугубит его
+        status_forcelist=[500, 502, 504],
+        # 429/503 с Retry-After тоже не повторяются внутри сессии: их видят concurrency
+        # и proxy_scheduler, повтор через другой прокси решает fetch_with_retries
+        respect_retry_after_header=False
     )
     session.mount('http://', HTTPAdapter(max_retries=retries))
     session.mount('https://', HTTPAdapter(max_retries=retries))
@@ -72,14 +183,917 @@ def setup_session(proxy=None):
     })
     return session
 
-def load_proxies():
+class SessionPool:
+    """
+    Пул долгоживущих сессий requests, до sessions_per_proxy на каждый прокси.
+
+    Сессия выдаётся одному потоку за раз и возвращается в пул после запроса,
+    поэтому TCP-соединение, CONNECT через прокси и TLS к eBay переиспользуются
+    между ссылками. Сессии, простаивающие дольше idle_timeout, закрываются.
+    """
+
+    def __init__(self, sessions_per_proxy=SESSIONS_PER_PROXY, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.sessions_per_proxy = sessions_per_proxy
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._idle = {}  # ключ прокси -> список (сессия, время последнего использования)
+        self._open = {}  # ключ прокси -> количество открытых сессий
+        self._next_eviction = time.monotonic() + idle_timeout
+
+    @contextmanager
+    def session(self, proxy=None):
+        """
+        Выдача сессии для прокси на время блока with.
+        """
+        key = proxy['http'] if proxy else None
+        session = self._acquire(key, proxy)
+        try:
+            yield session
+        except BaseException:
+            # После необработанного исключения сессию не переиспользуем
+            self._discard(key, session)
+            raise
+        self._release(key, session)
+
+    def _acquire(self, key, proxy):
+        with self._cond:
+            self._evict_idle()
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    return idle.pop()[0]
+                if self._open.get(key, 0) < self.sessions_per_proxy:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                self._cond.wait()
+        return setup_session(proxy)
+
+    def _release(self, key, session):
+        with self._cond:
+            self._idle.setdefault(key, []).append((session, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, key, session):
+        session.close()
+        with self._cond:
+            self._open[key] -= 1
+            self._cond.notify()
+
+    def _evict_idle(self):
+        # Вызывается под self._cond; полный обход не чаще раза в idle_timeout
+        now = time.monotonic()
+        if now < self._next_eviction:
+            return
+        self._next_eviction = now + self.idle_timeout
+        for key, idle in self._idle.items():
+            fresh = []
+            for session, last_used in idle:
+                if now - last_used > self.idle_timeout:
+                    session.close()
+                    self._open[key] -= 1
+                else:
+                    fresh.append((session, last_used))
+            idle[:] = fresh
+
+    def close_all(self):
+        """
+        Закрытие всех свободных сессий пула.
+        """
+        with self._cond:
+            for key, idle in self._idle.items():
+                for session, _ in idle:
+                    session.close()
+                self._open[key] -= len(idle)
+            self._idle.clear()
+
+class ResultCache:
+    """
+    Кэш количества результатов в локальном файле SQLite.
+
+    Ключ — каноническая ссылка (canonicalize_url). Записи старше ttl секунд
+    не выдаются и удаляются, при превышении max_entries вытесняются самые старые.
+    Записи до fresh_since (time.time()) тоже не выдаются: так цикл --daemon
+    перепроверяет ссылки, а не берёт результаты прошлого цикла. Ошибки в кэш не попадают.
+    """
+
+    EVICT_EVERY = 1000  # Проверка размера кэша раз в столько записей
+
+    def __init__(self, path=CACHE_FILE, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.fresh_since = 0.0
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "url TEXT PRIMARY KEY, stock INTEGER NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_fetched_at ON results (fetched_at)")
+        self.evict()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stock FROM results WHERE url = ? AND fetched_at >= ?",
+                (key, max(time.time() - self.ttl, self.fresh_since))
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, stock):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (url, stock, fetched_at) VALUES (?, ?, ?)",
+                (key, stock, time.time())
+            )
+            self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Удаление просроченных записей и самых старых сверх max_entries.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE fetched_at < ?", (time.time() - self.ttl,))
+            excess = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM results WHERE url IN "
+                    "(SELECT url FROM results ORDER BY fetched_at LIMIT ?)", (excess,)
+                )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+class UrlHistory:
+    """
+    История каждой ссылки в локальном файле SQLite: последнее значение, время последней
+    проверки и последнего изменения, число изменений и проверок.
+
+    Ключ — каноническая ссылка (canonicalize_url). Изменением считается смена наличия
+    (0 <-> больше 0): только она меняет файл загрузки. Записывается только из основного
+    потока, записи копятся и сохраняются пачками.
+    """
+
+    FLUSH_EVERY = 1000  # Записей в одной транзакции
+
+    def __init__(self, path=URL_HISTORY_FILE):
+        self._pending = []
+        # Шарды пишут в один файл, поэтому ожидание блокировки вместо ошибки
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS url_history ("
+            "url TEXT PRIMARY KEY, last_stock INTEGER NOT NULL, fetched_at REAL NOT NULL, "
+            "changed_at REAL NOT NULL, changes INTEGER NOT NULL, checks INTEGER NOT NULL) WITHOUT ROWID"
+        )
+
+    def get(self, key):
+        """
+        (last_stock, fetched_at, changed_at, changes, checks) или None для новой ссылки.
+        """
+        return self._conn.execute(
+            "SELECT last_stock, fetched_at, changed_at, changes, checks FROM url_history WHERE url = ?", (key,)
+        ).fetchone()
+
+    def record(self, key, stock):
+        self._pending.append((key, stock, time.time()))
+        if len(self._pending) >= self.FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        # В SET все выражения видят старую строку, поэтому порядок присваиваний не важен
+        self._conn.execute("BEGIN")
+        self._conn.executemany(
+            "INSERT INTO url_history (url, last_stock, fetched_at, changed_at, changes, checks) "
+            "VALUES (?1, ?2, ?3, ?3, 0, 1) ON CONFLICT(url) DO UPDATE SET "
+            "changes = changes + ((last_stock > 0) != (excluded.last_stock > 0)), "
+            "changed_at = CASE WHEN (last_stock > 0) != (excluded.last_stock > 0) "
+            "THEN excluded.fetched_at ELSE changed_at END, "
+            "last_stock = excluded.last_stock, fetched_at = excluded.fetched_at, checks = checks + 1",
+            self._pending
+        )
+        self._conn.execute("COMMIT")
+        self._pending.clear()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM url_history").fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+class RequestCoalescer:
+    """
+    Объединение одновременных запросов одной и той же ссылки в потоках:
+    первый поток выполняет загрузку, остальные ждут его результат.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def run(self, key, fetch):
+        """
+        Возвращает (result, leader), где leader=True у потока, выполнившего fetch().
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+        if not leader:
+            return future.result(), False
+        result = FetchResult(FetchStatus.ERROR)
+        try:
+            result = fetch()
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            future.set_result(result)
+        return result, True
+
+request_coalescer = RequestCoalescer()
+
+def significant_params(query):
+    """
+    Параметры запроса, от которых зависит количество результатов: без меток отслеживания,
+    параметров вида и листания и значений по умолчанию.
+    """
+    return [
+        (key, value) for key, value in parse_qsl(query, keep_blank_values=True)
+        if key not in TRACKING_PARAMS and key not in COUNT_NEUTRAL_PARAMS
+        and not key.startswith(TRACKING_PARAM_PREFIXES) and (key, value) not in DEFAULT_PARAMS
+    ]
+
+def canonicalize_url(url):
+    """
+    Приведение ссылки к каноническому виду для кэша и дедупликации:
+    &amp; из скопированных ссылок заменён на & (прочие сущности не раскрываются: &copy=2 — параметр),
+    схема и хост в нижнем регистре, без порта по умолчанию, фрагмента и параметров из significant_params,
+    параметры отсортированы.
+    Ссылка и её rewrite_url() дают один ключ.
+    """
+    parts = urlsplit(url.strip().replace('&amp;', '&'))
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    default_port = DEFAULT_PORTS.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    query = sorted(significant_params(parts.query))
+    return urlunsplit((scheme, netloc, parts.path or '/', urlencode(query), ''))
+
+def rewrite_url(url):
+    """
+    Самый дешёвый равноценный запрос для ссылки поиска: только значимые параметры
+    и REWRITE_PAGE_SIZE товаров на странице. Заголовок с количеством результатов тот же,
+    страница меньше. Прочие ссылки возвращаются без изменений. Проверка — --verify-rewrite.
+    """
+    parts = urlsplit(url.strip().replace('&amp;', '&'))
+    if SEARCH_PATH_MARKER not in parts.path:
+        return url
+    query = significant_params(parts.query) + [('_ipg', str(REWRITE_PAGE_SIZE))]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+class ProxyStats:
+    """
+    Состояние одного прокси в ProxyScheduler.
+    """
+    __slots__ = ('proxy', 'latency', 'success_rate', 'consecutive_failures', 'requests', 'errors',
+                 'state', 'open_until', 'cooldown', 'probing')
+
+    def __init__(self, proxy, cooldown):
+        self.proxy = proxy
+        self.latency = None  # EWMA задержки в секундах
+        self.success_rate = 1.0  # EWMA доли успешных запросов
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.state = ProxyScheduler.CLOSED
+        self.open_until = 0.0
+        self.cooldown = cooldown
+        self.probing = False
+
+    def score(self):
+        # Быстрые и надёжные прокси получают больше запросов
+        latency = self.latency if self.latency is not None else TIMEOUT / 2
+        return self.success_rate ** 2 / max(latency, 0.05)
+
+class ProxyScheduler:
+    """
+    Потокобезопасный выбор прокси с учётом их состояния.
+
+    Для каждого прокси ведутся EWMA задержки и доли успешных запросов; прокси
+    выбирается случайно с весом по этим показателям. После breaker_threshold
+    ошибок подряд прокси выводится из работы (open) на cooldown секунд, затем
+    получает один пробный запрос (half-open): успех возвращает его в работу,
+    ошибка снова выводит с удвоенной паузой (не больше max_cooldown).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, proxies, alpha=PROXY_EWMA_ALPHA, breaker_threshold=PROXY_BREAKER_THRESHOLD,
+                 cooldown=PROXY_BREAKER_COOLDOWN, max_cooldown=PROXY_BREAKER_MAX_COOLDOWN):
+        self.alpha = alpha
+        self.breaker_threshold = breaker_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self._stats = {proxy['http']: ProxyStats(proxy, cooldown) for proxy in proxies}
+
+    def __len__(self):
+        return len(self._stats)
+
+    def acquire(self, exclude=()):
+        """
+        Выбор прокси для запроса; exclude — ключи прокси, которых лучше избежать.
+        Без прокси возвращает None (прямое подключение).
+        """
+        if not self._stats:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            candidates = []
+            for key, stats in self._stats.items():
+                if stats.state == self.OPEN and now >= stats.open_until:
+                    stats.state = self.HALF_OPEN
+                    stats.probing = False
+                if stats.state == self.CLOSED or (stats.state == self.HALF_OPEN and not stats.probing):
+                    if key not in exclude:
+                        candidates.append(stats)
+            if not candidates:
+                # Все прокси выведены из работы: берём тот, что вернётся раньше всех
+                stats = min(self._stats.values(), key=lambda s: (s.proxy['http'] in exclude, s.open_until))
+            else:
+                stats = random.choices(candidates, weights=[c.score() for c in candidates])[0]
+            if stats.state == self.HALF_OPEN:
+                stats.probing = True
+            return stats.proxy
+
+    def report(self, proxy, ok, latency):
+        """
+        Учёт результата запроса через прокси.
+        """
+        if proxy is None:
+            return
+        with self._lock:
+            stats = self._stats.get(proxy['http'])
+            if stats is None:
+                return
+            stats.requests += 1
+            stats.latency = latency if stats.latency is None else (
+                self.alpha * latency + (1 - self.alpha) * stats.latency)
+            stats.success_rate = self.alpha * (1.0 if ok else 0.0) + (1 - self.alpha) * stats.success_rate
+            if ok:
+                stats.consecutive_failures = 0
+                if stats.state != self.CLOSED:
+                    stats.state = self.CLOSED
+                    stats.cooldown = self.cooldown
+                return
+            stats.errors += 1
+            stats.consecutive_failures += 1
+            if stats.state == self.HALF_OPEN:
+                stats.cooldown = min(stats.cooldown * 2, self.max_cooldown)
+                self._open(stats)
+            elif stats.state == self.CLOSED and stats.consecutive_failures >= self.breaker_threshold:
+                self._open(stats)
+
+    def cancel(self, proxy):
+        """
+        Запрос через прокси отменён без результата: прокси не штрафуется,
+        пробный запрос (half-open) можно выдать снова.
+        """
+        if proxy is None:
+            return
+        with self._lock:
+            stats = self._stats.get(proxy['http'])
+            if stats is not None:
+                stats.probing = False
+
+    def disable(self, proxy):
+        """
+        Вывод прокси из работы по результату проверки (--lazy-proxy-check).
+        Прокси вернётся только через пробный запрос после max_cooldown.
+        """
+        with self._lock:
+            stats = self._stats.get(proxy['http'])
+            if stats is not None:
+                stats.state = self.OPEN
+                stats.probing = False
+                stats.cooldown = self.max_cooldown
+                stats.open_until = time.monotonic() + self.max_cooldown
+
+    def _open(self, stats):
+        stats.state = self.OPEN
+        stats.probing = False
+        stats.open_until = time.monotonic() + stats.cooldown
+        logging.warning(f"{Fore.YELLOW}Proxy {stats.proxy['http']} paused for {stats.cooldown}s after {stats.consecutive_failures} errors in a row{Style.RESET_ALL}")
+
+    def snapshot(self):
+        """
+        Текущие показатели всех прокси, лучшие первыми.
+        """
+        with self._lock:
+            rows = [{
+                'proxy': key,
+                'state': stats.state,
+                'score': round(stats.score(), 3),
+                'latency': round(stats.latency, 3) if stats.latency is not None else None,
+                'success_rate': round(stats.success_rate, 3),
+                'requests': stats.requests,
+                'errors': stats.errors,
+            } for key, stats in self._stats.items()]
+        return sorted(rows, key=lambda row: row['score'], reverse=True)
+
+    def top_errors(self, n=3):
+        with self._lock:
+            ranked = sorted(self._stats.items(), key=lambda item: item[1].errors, reverse=True)
+        return [(key, stats.errors) for key, stats in ranked[:n] if stats.errors]
+
+class TokenBucket:
+    """
+    Ограничение частоты запросов: rate запросов в секунду, до burst подряд.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """
+        Резервирование одного запроса. Возвращает, сколько секунд подождать перед ним.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class ProxyRateLimiter:
+    """
+    Отдельный TokenBucket на каждый прокси (и на прямое подключение).
+    """
+
+    def __init__(self, rate=PROXY_RATE, burst=PROXY_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def delay(self, proxy):
+        """
+        Сколько секунд подождать перед запросом через прокси.
+        """
+        if self.rate <= 0:
+            return 0.0
+        key = proxy['http'] if proxy else None
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return bucket.reserve()
+
+class ConcurrencyController:
+    """
+    Адаптивное число одновременных запросов (AIMD).
+
+    Пока запросы успешны и средняя задержка ниже latency_target, предел растёт
+    примерно на единицу за каждые limit запросов. При ограничении частоты
+    (429/503 или капча) или доле ошибок выше CONCURRENCY_ERROR_RATE предел умножается
+    на CONCURRENCY_DECREASE, но не чаще раза в latency_target секунд.
+    С adaptive=False предел остаётся равным initial.
+    """
+
+    def __init__(self, initial=MAX_THREADS, min_limit=CONCURRENCY_MIN, max_limit=CONCURRENCY_MAX,
+                 latency_target=CONCURRENCY_LATENCY_TARGET, adaptive=True):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.adaptive = adaptive
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.inflight = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.throttled = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        """
+        Занять место для запроса без ожидания. Возвращает True при успехе.
+        """
+        with self._cond:
+            if self.inflight < int(self.limit):
+                self.inflight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    def release(self, result=None):
+        """
+        Освобождение места с учётом результата запроса (FetchResult).
+        Окончательные ответы вроде 404 ошибкой не считаются.
+        Без result (запрос не отправлялся) место просто возвращается.
+        """
+        with self._cond:
+            self.inflight -= 1
+            if result is None:
+                self._cond.notify_all()
+                return
+            failed = not result.ok and result.retryable
+            self.latency = result.latency if self.latency is None else (
+                PROXY_EWMA_ALPHA * result.latency + (1 - PROXY_EWMA_ALPHA) * self.latency)
+            self.error_rate = PROXY_EWMA_ALPHA * (1.0 if failed else 0.0) + (1 - PROXY_EWMA_ALPHA) * self.error_rate
+            throttled = result.status in (FetchStatus.THROTTLED, FetchStatus.CAPTCHA)
+            if throttled:
+                self.throttled += 1
+            if self.adaptive:
+                if throttled or self.error_rate > CONCURRENCY_ERROR_RATE:
+                    self._decrease()
+                elif not failed and self.latency <= self.latency_target:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.latency_target:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * CONCURRENCY_DECREASE)
+        self.decreases += 1
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'inflight': self.inflight,
+                'latency': round(self.latency, 3) if self.latency is not None else None,
+                'error_rate': round(self.error_rate, 3),
+                'throttled': self.throttled,
+                'decreases': self.decreases,
+            }
+
+class HedgePolicy:
+    """
+    Запасные запросы (--hedge) против долгого хвоста задержек.
+
+    Задержки успешных запросов копятся в окне последних window замеров. Если ответа нет
+    дольше percentile-го процентиля окна, тот же запрос уходит через другой прокси.
+    Запасных запросов не больше budget от числа основных, до min_samples замеров их нет.
+    """
+
+    RECOMPUTE_EVERY = 20  # Процентиль пересчитывается раз в столько замеров
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, budget=HEDGE_BUDGET, window=HEDGE_WINDOW,
+                 min_samples=HEDGE_MIN_SAMPLES):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self._observed = 0
+        self._delay = None
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def observe(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+            self._observed += 1
+            if len(self._samples) >= self.min_samples and self._observed % self.RECOMPUTE_EVERY == 0:
+                self._delay = float(np.percentile(self._samples, self.percentile))
+
+    def delay(self):
+        """
+        Учёт основного запроса. Сколько секунд ждать ответа до запасного запроса (None — не отправлять).
+        """
+        with self._lock:
+            self.requests += 1
+            return self._delay
+
+    def try_hedge(self):
+        """
+        Разрешение на запасной запрос в пределах budget.
+        """
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def won(self):
+        with self._lock:
+            self.wins += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'delay': None if self._delay is None else round(self._delay, 3),
+                'requests': self.requests,
+                'hedges': self.hedges,
+                'wins': self.wins,
+            }
+
+def proxy_label(proxy):
+    """
+    Адрес прокси без логина и пароля для метрик и журнала запросов.
+    """
+    if not proxy:
+        return 'direct'
+    return urlsplit(proxy['http']).netloc.rpartition('@')[2]
+
+class Metrics:
+    """
+    Потокобезопасные счётчики и гистограммы с метками.
+
+    Выгружаются в текстовом формате Prometheus (to_prometheus) или в JSON (snapshot).
+    stores — названия магазинов по номеру пары для метки store.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.stores = {}
+        self._lock = threading.Lock()
+        self._counters = {}  # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> [счётчики по границам..., сумма, количество]
+
+    def store(self, pair_idx):
+        return self.stores.get(pair_idx, str(pair_idx))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self):
+        """
+        Снимок всех метрик в виде словаря для JSON.
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels),
+                           'buckets': dict(zip(map(str, self.buckets), histogram[:-2])),
+                           'sum': histogram[-2], 'count': histogram[-1]}
+                          for (name, labels), histogram in sorted(self._histograms.items())]
+        return {'time': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+        lines = []
+        snapshot = self.snapshot()
+        typed = set()
+        for counter in snapshot['counters']:
+            if counter['name'] not in typed:
+                typed.add(counter['name'])
+                lines.append(f"# TYPE {counter['name']} counter")
+            lines.append(f"{counter['name']}{format_labels(counter['labels'].items())} {counter['value']}")
+        for histogram in snapshot['histograms']:
+            name, labels = histogram['name'], histogram['labels'].items()
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in histogram['buckets'].items():
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Атомарная запись метрик: JSON для *.json, иначе текстовый формат Prometheus.
+        """
+        if path.endswith('.json'):
+            content = json.dumps(self.snapshot(), ensure_ascii=False, indent=1)
+        else:
+            content = self.to_prometheus()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+# Метрики текущего запуска
+metrics = Metrics()
+
+def export_metrics(path, interval, stop_event):
+    """
+    Периодическая запись метрик в файл до установки stop_event, затем последняя запись.
+    """
+    while not stop_event.wait(interval):
+        try:
+            metrics.write(path)
+        except OSError as e:
+            logging.warning(f"{Fore.YELLOW}Could not write metrics to '{path}': {e}{Style.RESET_ALL}")
+    metrics.write(path)
+
+class TraceLog:
+    """
+    Журнал каждого запроса в формате JSONL (--trace-log).
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def record_fetch(url, proxy, pair_idx, attempt, result):
+    """
+    Учёт одной попытки загрузки в метриках и журнале запросов.
+    """
+    label = proxy_label(proxy)
+    store = metrics.store(pair_idx)
+    status = result.status.value
+    network_time = result.latency - result.parse_time
+    metrics.inc('stock_requests_total', proxy=label, store=store, status=status)
+    metrics.inc('stock_bytes_total', result.bytes, proxy=label)
+    metrics.observe('stock_network_seconds', network_time, proxy=label, status=status)
+    metrics.observe('stock_store_network_seconds', network_time, store=store)
+    if result.parse_time:
+        metrics.observe('stock_parse_seconds', result.parse_time)
+    if attempt:
+        metrics.inc('stock_retries_total', store=store)
+    if trace_log is not None:
+        trace_log.write({
+            'time': round(time.time(), 3),
+            'url': url,
+            'store': store,
+            'proxy': label,
+            'attempt': attempt,
+            'status': status,
+            'status_code': result.status_code,
+            'error': result.error,
+            'latency': round(result.latency, 4),
+            'parse_time': round(result.parse_time, 4),
+            'bytes': result.bytes,
+        })
+
+def format_timedelta(td):
+    """
+    Форматирование интервала времени для строки прогресса.
+    """
+    total_seconds = int(td.total_seconds())
+    hours, remainder = divmod(total_seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours > 0:
+        return f"{hours}h {minutes}m {seconds}s"
+    elif minutes > 0:
+        return f"{minutes}m {seconds}s"
+    else:
+        return f"{seconds}s"
+
+class ProgressReporter:
     """
-    Загрузка прокси из файла proxies.txt.
+    Строка прогресса, которая перерисовывается в отдельном потоке раз в refresh_interval секунд.
+
+    Основной цикл только обновляет счётчики через update(); ETA считается по скорости
+    за последние window секунд, восстановленные из журнала ссылки в скорость не входят.
+    С enabled=False строка не выводится (--no-progress).
+    """
+
+    def __init__(self, total, pairs_total, resumed=0, refresh_interval=PROGRESS_INTERVAL, window=PROGRESS_WINDOW,
+                 enabled=True):
+        self.total = total
+        self.pairs_total = pairs_total
+        self.refresh_interval = refresh_interval
+        self.window = window
+        self.enabled = enabled
+        self.processed = resumed
+        self.errors = 0
+        self.pairs_done = 0
+        self._samples = deque([(time.monotonic(), resumed)])
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.enabled:
+            self._thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+            self._thread.start()
+
+    def update(self, processed, errors, pairs_done):
+        # Простые присваивания: поток вывода читает их без блокировки
+        self.processed = processed
+        self.errors = errors
+        self.pairs_done = pairs_done
+
+    def log(self, message):
+        """
+        Сообщение в лог поверх строки прогресса.
+        """
+        with self._write_lock:
+            if self.enabled:
+                sys.stdout.write('\r\033[K')
+            logging.info(message)
+
+    def _rate(self, now, processed):
+        samples = self._samples
+        samples.append((now, processed))
+        while len(samples) > 2 and now - samples[1][0] >= self.window:
+            samples.popleft()
+        start_time, start_processed = samples[0]
+        if now <= start_time:
+            return 0.0
+        return (processed - start_processed) / (now - start_time)
+
+    def render(self):
+        processed = self.processed
+        total = self.total
+        rate = self._rate(time.monotonic(), processed)
+        eta = format_timedelta(timedelta(seconds=(total - processed) / rate)) if rate > 0 else "--"
+        percentage = (processed / total) * 100 if total else 100
+        bar_length = 20
+        filled_length = int(bar_length * processed // total) if total else bar_length
+        bar = '#' * filled_length + '-' * (bar_length - filled_length)
+
+        # Топ-3 прокси с наибольшим количеством ошибок
+        top_errors = proxy_scheduler.top_errors(3) if proxy_scheduler is not None else []
+        top_errors_str = ', '.join([f"{proxy}: {errs}" for proxy, errs in top_errors]) if top_errors else "None"
+        limit = int(concurrency.limit) if concurrency is not None else 0
+        return (
+            f"\r{Fore.CYAN}Overall Progress: |{bar}| {percentage:.2f}% "
+            f"({processed}/{total}) | Pairs done: {self.pairs_done}/{self.pairs_total} "
+            f"| ETA Global: {eta} ({rate:.1f}/s) | Errors: {self.errors} | Concurrency: {limit} "
+            f"| Top Proxy Errors: {top_errors_str}{Style.RESET_ALL}"
+        )
+
+    def _draw(self):
+        with self._write_lock:
+            sys.stdout.write(self.render())
+            sys.stdout.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            self._draw()
+
+    def stop(self):
+        """
+        Остановка потока и последняя перерисовка строки прогресса.
+        """
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._draw()
+            print()  # Для переноса строки после прогресс-бара
+
+def load_proxies(path=PROXIES_FILE):
+    """
+    Загрузка прокси из файла (по умолчанию proxies.txt).
     Формат каждой строки: ip:port:user:pwd
     """
     proxies = []
     try:
-        with open('proxies.txt', 'r', encoding='utf-8') as f:
+        with open(path, 'r', encoding='utf-8') as f:
             for line in f:
                 line = line.strip()
                 if line.count(':') == 3:
@@ -94,397 +1108,1326 @@ def load_proxies():
 def check_proxy(proxy):
     """
     Проверка работоспособности прокси на доступ к eBay.
+    Читается только код ответа и первые PROXY_CHECK_BYTES байт небольшой страницы.
     """
-    test_url = "https://www.ebay.com"
     try:
-        with setup_session(proxy) as session:
-            response = session.get(test_url, timeout=TIMEOUT)
-            if response.status_code == 200 and "eBay" in response.text:
-                return True
-            else:
-                return False
+        # Сессия из пула: соединение, открытое при проверке, потом используется для работы
+        with session_pool.session(proxy) as session:
+            with session.get(PROXY_CHECK_URL, timeout=TIMEOUT, stream=True) as response:
+                if response.status_code != 200:
+                    return False
+                head = next(response.iter_content(PROXY_CHECK_BYTES), b'')
+                return PROXY_CHECK_MARKER in head.lower()
     except:
         return False
 
-def process_product(session, url):
+class ProxyCheckCache:
     """
-    Парсинг страницы по URL и извлечение количества результатов.
+    Результаты проверки прокси в JSON-файле, чтобы запуски подряд не проверяли их заново.
+    Ключ — хэш адреса прокси, чтобы логины и пароли не попадали в файл.
     """
-    try:
-        response = session.get(url, timeout=TIMEOUT)
-        response.raise_for_status()
-        tree = html.fromstring(response.content)
-        result_elements = tree.xpath("//h1[@class='srp-controls__count-heading']")
-        if result_elements:
-            text = result_elements[0].text_content().strip()
-            match = RESULTS_PATTERN.search(text)
-            if match:
-                return int(match.group(1).replace(',', ''))
-        return 0
-    except:
-        return "Error"
 
-def worker(url, proxy, pair_idx, row, sku, parser_link):
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def _key(proxy):
+        return hashlib.sha1(proxy['http'].encode('utf-8')).hexdigest()
+
+    def get(self, proxy):
+        """
+        Свежий результат проверки (True/False) или None.
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(proxy))
+        if entry and time.time() - entry['checked'] < self.ttl:
+            return entry['ok']
+        return None
+
+    def put(self, proxy, ok):
+        with self._lock:
+            self._entries[self._key(proxy)] = {'ok': ok, 'checked': time.time()}
+
+    def save(self):
+        """
+        Атомарная запись файла; устаревшие записи отбрасываются.
+        """
+        now = time.time()
+        with self._lock:
+            entries = {key: entry for key, entry in self._entries.items() if now - entry['checked'] < self.ttl}
+        # Несколько процессов (--shards) могут писать один файл одновременно
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"{Fore.YELLOW}Could not save proxy check cache '{self.path}': {e}{Style.RESET_ALL}")
+
+def check_proxies(proxies, check_cache, on_result=None):
     """
-    Рабочая функция для обработки одной ссылки с использованием прокси.
+    Проверка прокси, для которых в check_cache нет свежего результата.
+    on_result(proxy, ok) вызывается по мере готовности. Возвращает (valid, invalid).
     """
-    global failed_urls, proxy_errors_count
-    try:
-        with setup_session(proxy) as session:
-            result = process_product(session, url)
-            if result == "Error":
-                if proxy and proxy['http'] in proxy_errors_count:
-                    proxy_errors_count[proxy['http']] += 1
-                elif proxy:
-                    proxy_errors_count[proxy['http']] = 1
-                # Добавление ссылки в список неудачных
-                failed_urls.append({
-                    'pair_idx': pair_idx,
-                    'row': row,
-                    'sku': sku,
-                    'parser_link': parser_link,
-                    'url': url
-                })
-            return url, result
-    except:
-        if proxy and proxy['http'] in proxy_errors_count:
-            proxy_errors_count[proxy['http']] += 1
-        elif proxy:
-            proxy_errors_count[proxy['http']] = 1
-        # Добавление ссылки в список неудачных
-        failed_urls.append({
-            'pair_idx': pair_idx,
-            'row': row,
-            'sku': sku,
-            'parser_link': parser_link,
-            'url': url
-        })
-        return url, "Error"
+    valid_proxies = []
+    invalid_proxies = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+        future_to_proxy = {executor.submit(check_proxy, proxy): proxy for proxy in proxies}
+        for future in concurrent.futures.as_completed(future_to_proxy):
+            proxy = future_to_proxy[future]
+            try:
+                ok = future.result()
+            except Exception:
+                ok = False
+            check_cache.put(proxy, ok)
+            (valid_proxies if ok else invalid_proxies).append(proxy)
+            if on_result:
+                on_result(proxy, ok)
+    check_cache.save()
+    return valid_proxies, invalid_proxies
 
-def save_workbook_with_retries(output_wb, filename='StockReady.xlsx', retries=5, delay=5):
+class FetchStatus(Enum):
     """
-    Попытка сохранить рабочую книгу с повторными попытками при ошибках.
+    Итог загрузки одной страницы.
     """
-    for attempt in range(1, retries + 1):
-        try:
-            output_wb.save(filename)
-            logging.info(f"{Fore.GREEN}Workbook saved successfully to '{filename}'.{Style.RESET_ALL}")
-            return True
-        except PermissionError:
-            logging.error(f"{Fore.RED}PermissionError: Unable to save '{filename}'. Attempt {attempt} of {retries}. Ensure the file is closed.{Style.RESET_ALL}")
-            if attempt < retries:
-                logging.info(f"{Fore.YELLOW}Retrying in {delay} seconds...{Style.RESET_ALL}")
-                time.sleep(delay)
-            else:
-                logging.error(f"{Fore.RED}Failed to save '{filename}' after {retries} attempts. Exiting.{Style.RESET_ALL}")
-                return False
-        except Exception as e:
-            logging.error(f"{Fore.RED}Error saving '{filename}': {e}{Style.RESET_ALL}")
-            return False
-    return False
+    OK = 'ok'  # Заголовок с количеством результатов найден
+    NO_HEADING = 'no_heading'  # Страница без заголовка, считается как 0 результатов
+    ENDED = 'ended'  # Объявление завершено, 0 результатов
+    NOT_FOUND = 'not_found'  # 404/410
+    HTTP_ERROR = 'http_error'  # Прочие коды 4xx/5xx
+    THROTTLED = 'throttled'  # 429/503
+    CAPTCHA = 'captcha'  # Перенаправление на капчу или страница с капчей
+    BLOCKED = 'blocked'  # 403
+    PROXY_ERROR = 'proxy_error'  # Ошибка прокси или 407
+    TIMEOUT = 'timeout'
+    CONNECTION_ERROR = 'connection_error'
+    ERROR = 'error'  # Прочие исключения
+    CACHED = 'cached'  # Свежий результат из кэша, без запроса
+    CANCELLED = 'cancelled'  # Запрос отменён: ответ уже пришёл через другой прокси (--hedge)
+    DEFERRED = 'deferred'  # Отложено бюджетом, взято последнее значение из UrlHistory
 
-def main():
-    global failed_urls, proxy_errors_count
-    error_count = 0
-    total_links = 0
-    global_processed = 0
+# Итоги, при которых количество результатов известно
+COUNT_STATUSES = {FetchStatus.OK, FetchStatus.NO_HEADING, FetchStatus.ENDED, FetchStatus.CACHED, FetchStatus.DEFERRED}
+# Ошибки, которые имеет смысл повторить через другой прокси
+RETRYABLE_STATUSES = {FetchStatus.THROTTLED, FetchStatus.CAPTCHA, FetchStatus.BLOCKED, FetchStatus.PROXY_ERROR,
+                      FetchStatus.TIMEOUT, FetchStatus.CONNECTION_ERROR}
+# Ошибки, за которые штрафуется прокси
+PROXY_FAULT_STATUSES = RETRYABLE_STATUSES
 
-    try:
-        workbook = load_workbook(filename='Stock_All.xlsx')
-        sheet = workbook.active
-        logging.info(f"{Fore.GREEN}Loaded 'Stock_All.xlsx' successfully.{Style.RESET_ALL}")
-    except Exception as e:
-        logging.error(f"{Fore.RED}Error loading Excel file: {e}{Style.RESET_ALL}")
-        return
+class FetchResult:
+    """
+    Результат загрузки: итог (FetchStatus), количество результатов, код HTTP,
+    имя класса исключения, задержка в секундах (вместе с разбором), время разбора,
+    число прочитанных байт и прокси последней попытки (proxy_label).
+    """
+    __slots__ = ('status', 'count', 'status_code', 'error', 'latency', 'parse_time', 'bytes', 'proxy')
 
-    # Подсчёт общего количества ссылок
-    for sku_col, parser_col in COLUMN_PAIRS:
-        for row in range(3, sheet.max_row + 1):
-            url = sheet[f'{parser_col}{row}'].value
-            if url and isinstance(url, str):
-                total_links += 1
-    logging.info(f"{Fore.GREEN}Total URLs to process: {total_links}{Style.RESET_ALL}")
+    def __init__(self, status, count=None, status_code=None, error=None, latency=0.0, parse_time=0.0, bytes=0,
+                 proxy=None):
+        self.status = status
+        self.count = count
+        self.status_code = status_code
+        self.error = error
+        self.latency = latency
+        self.parse_time = parse_time
+        self.bytes = bytes
+        self.proxy = proxy
 
-    proxies = load_proxies()
-    valid_proxies = []
-    invalid_proxies = []
-    if proxies:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            future_to_proxy = {executor.submit(check_proxy, proxy): proxy for proxy in proxies}
-            for future in concurrent.futures.as_completed(future_to_proxy):
-                proxy = future_to_proxy[future]
-                try:
-                    if future.result():
-                        valid_proxies.append(proxy)
-                    else:
-                        invalid_proxies.append(proxy)
-                except Exception as e:
-                    invalid_proxies.append(proxy)
-    # Упрощённый вывод проверки прокси
-    logging.info(f"{Fore.GREEN}All proxies have been checked.{Style.RESET_ALL}")
-    logging.info(f"{Fore.GREEN}Valid proxies: {len(valid_proxies)}{Style.RESET_ALL}")
-    if invalid_proxies:
-        logging.warning(f"{Fore.YELLOW}Invalid proxies: {len(invalid_proxies)}{Style.RESET_ALL}")
-        for proxy in invalid_proxies:
-            logging.warning(f" - Proxy {proxy['http']}{Style.RESET_ALL}")
-
-    if not valid_proxies and proxies:
-        logging.error(f"{Fore.RED}No valid proxies available. Exiting.{Style.RESET_ALL}")
-        return
+    @property
+    def ok(self):
+        return self.status in COUNT_STATUSES
 
-    # Создание нового Excel-файла для результатов
-    output_wb = Workbook()
-    output_ws = output_wb.active
-    output_ws.title = "StockReady"
+    @property
+    def retryable(self):
+        # 5xx (и RetryError без кода) — временная ошибка сервера, прочие 4xx окончательны
+        if self.status is FetchStatus.HTTP_ERROR:
+            return self.status_code is None or self.status_code >= 500
+        return self.status in RETRYABLE_STATUSES
 
-    # Инициализация столбца для записи результатов
-    current_col = 1  # Начинаем с первого столбца
+    @property
+    def proxy_fault(self):
+        return self.status in PROXY_FAULT_STATUSES
 
-    # Общий прогресс обработки всех ссылок
-    overall_start_time = datetime.now()
+    @property
+    def value(self):
+        """
+        Значение для StockReady.xlsx: количество результатов или "Error".
+        """
+        return self.count if self.ok else "Error"
 
-    for idx, (sku_col, parser_col) in enumerate(COLUMN_PAIRS, start=1):
-        urls = []
-        for row in range(3, sheet.max_row + 1):
-            sku = sheet[f'{sku_col}{row}'].value
-            url = sheet[f'{parser_col}{row}'].value
-            if url and isinstance(url, str):
-                urls.append({'row': row, 'sku': sku, 'url': url, 'parser_link': url})
-        logging.info(f"{Fore.GREEN}Loaded {len(urls)} URLs from columns {sku_col}-{parser_col} in 'Stock_All.xlsx'{Style.RESET_ALL}")
-        if not urls:
-            logging.warning(f"{Fore.YELLOW}No URLs found in columns {sku_col}-{parser_col}. Skipping this pair.{Style.RESET_ALL}")
-            # При отсутствии данных для данной пары, оставляем пустные столбцы
-            current_col += 3 + 1  # Три столбца данных и один пустой
-            continue
+def parse_result_count(content):
+    """
+    Извлечение количества результатов из HTML страницы поиска.
+    Возвращает None, если заголовка с количеством на странице нет.
+    """
+    tree = html.fromstring(content)
+    result_elements = tree.xpath("//h1[@class='srp-controls__count-heading']")
+    if result_elements:
+        text = result_elements[0].text_content().strip()
+        match = RESULTS_PATTERN.search(text)
+        if match:
+            return int(match.group(1).replace(',', ''))
+    return None
 
-        # Получение названия магазина из первой строки соответствующего столбца SKU
-        store_name_cell = f"{sku_col}1"
-        store_name = sheet[store_name_cell].value
-        if not store_name:
-            store_name = f"Store_{idx}"  # Если название не найдено, использовать дефолтное
-            logging.warning(f"{Fore.YELLOW}Store name not found in cell {store_name_cell}. Using default name '{store_name}'.{Style.RESET_ALL}")
-        else:
-            logging.info(f"{Fore.BLUE}Store name for pair {idx}: {store_name}{Style.RESET_ALL}")
+def parse_page(content):
+    """
+    Разбор страницы целиком. Возвращает (FetchStatus, количество результатов).
+    """
+    count = parse_result_count(content)
+    if count is not None:
+        return FetchStatus.OK, count
+    lowered = content.lower()
+    if CAPTCHA_MARKER in lowered:
+        return FetchStatus.CAPTCHA, None
+    if any(marker in lowered for marker in ENDED_MARKERS):
+        return FetchStatus.ENDED, 0
+    return FetchStatus.NO_HEADING, 0
 
-        results = []
-        processed = 0
-        total = len(urls)
-        start_time = datetime.now()
-        if valid_proxies:
-            proxy_cycle = iter(valid_proxies)
-        else:
-            proxy_cycle = iter([None])
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            futures = []
-            for item in urls:
-                url = item['url']
-                row = item['row']
-                sku = item['sku']
-                parser_link = item['parser_link']
-                try:
-                    proxy = next(proxy_cycle)
-                except StopIteration:
-                    if valid_proxies:
-                        proxy_cycle = iter(valid_proxies)
-                        proxy = next(proxy_cycle)
-                    else:
-                        proxy = None
-                futures.append(executor.submit(worker, url, proxy, idx, row, sku, parser_link))
-
-            for future in concurrent.futures.as_completed(futures):
-                url, count = future.result()
-                if count == "Error":
-                    error_count += 1
-                else:
-                    results.append({'url': url, 'stock': count})
-                processed += 1
-                global_processed += 1
-
-                # Удаление прокси с слишком большим количеством ошибок
-                proxies_to_remove = [proxy for proxy, errs in proxy_errors_count.items() if errs >= 5]
-                for proxy in proxies_to_remove:
-                    logging.warning(f"{Fore.YELLOW}Removing proxy {proxy} due to too many errors{Style.RESET_ALL}")
-                    valid_proxies = [p for p in valid_proxies if p['http'] != proxy]
-                    del proxy_errors_count[proxy]
-                    proxy_cycle = iter(valid_proxies) if valid_proxies else iter([None])
-
-                # Обновление прогресса
-                elapsed_time = datetime.now() - start_time
-                if processed > 0:
-                    avg_time_per_item = elapsed_time / processed
-                    remaining_items_pair = total - processed
-                    remaining_time_pair = avg_time_per_item * remaining_items_pair
-                else:
-                    remaining_time_pair = timedelta(seconds=0)
+class ResultCountScanner:
+    """
+    Потоковый поиск заголовка srp-controls__count-heading в байтах ответа.
 
-                if global_processed > 0:
-                    overall_elapsed_time = datetime.now() - overall_start_time
-                    avg_time_per_item_global = overall_elapsed_time / global_processed
-                    remaining_items_global = total_links - global_processed
-                    remaining_time_global = avg_time_per_item_global * remaining_items_global
-                else:
-                    remaining_time_global = timedelta(seconds=0)
-
-                # Форматирование времени
-                def format_timedelta(td):
-                    total_seconds = int(td.total_seconds())
-                    hours, remainder = divmod(total_seconds, 3600)
-                    minutes, seconds = divmod(remainder, 60)
-                    if hours > 0:
-                        return f"{hours}h {minutes}m {seconds}s"
-                    elif minutes > 0:
-                        return f"{minutes}m {seconds}s"
-                    else:
-                        return f"{seconds}s"
-
-                eta_pair = format_timedelta(remaining_time_pair)
-                eta_global = format_timedelta(remaining_time_global)
-
-                percentage_pair = (processed / total) * 100 if total else 100
-                percentage_global = (global_processed / total_links) * 100 if total_links else 100
-
-                bar_length = 20
-                filled_length_pair = int(bar_length * processed // total) if total else bar_length
-                bar_pair = '#' * filled_length_pair + '-' * (bar_length - filled_length_pair)
-
-                filled_length_global = int(bar_length * global_processed // total_links) if total_links else bar_length
-                bar_global = '#' * filled_length_global + '-' * (bar_length - filled_length_global)
-
-                # Получение топ-3 прокси с наибольшим количеством ошибок
-                top_errors = sorted(proxy_errors_count.items(), key=lambda x: x[1], reverse=True)[:3]
-                top_errors_str = ', '.join([f"{proxy}: {errs}" for proxy, errs in top_errors]) if top_errors else "None"
-
-                progress_message = (
-                    f"\r{Fore.CYAN}Overall Progress: |{bar_global}| {percentage_global:.2f}% "
-                    f"({global_processed}/{total_links}) | Pair {idx}: |{bar_pair}| {percentage_pair:.2f}% "
-                    f"({processed}/{total}) | ETA Global: {eta_global} | ETA Pair: {eta_pair} | Errors: {error_count} | Top Proxy Errors: {top_errors_str}{Style.RESET_ALL}"
-                )
-                sys.stdout.write(progress_message)
-                sys.stdout.flush()
-        print()  # Для переноса строки после прогресс-бара
-
-        # Подготовка данных для записи в новый Excel
-        data = []
-        url_to_stock = {res['url']: res['stock'] for res in results}
-        for item in urls:
-            sku = item['sku']
-            url = item['url']
-            stock = url_to_stock.get(url, "Error")
-            data.append({'SKU': sku, 'ParserLink': url, 'Stock': stock})
-
-        # Запись названия магазина (Store Name) в первую строку, слияние ячеек
-        try:
-            output_ws.merge_cells(start_row=1, start_column=current_col, end_row=1, end_column=current_col + 2)
-            output_ws.cell(row=1, column=current_col, value=store_name)
-            logging.info(f"{Fore.BLUE}Inserted store name '{store_name}' in columns {current_col}-{current_col + 2}.{Style.RESET_ALL}")
-        except Exception as e:
-            logging.error(f"{Fore.RED}Error inserting store name '{store_name}': {e}{Style.RESET_ALL}")
-
-        # Запись заголовков для текущего аккаунта во вторую строку
-        output_ws.cell(row=2, column=current_col, value="SKU")
-        output_ws.cell(row=2, column=current_col + 1, value="ParserLink")
-        output_ws.cell(row=2, column=current_col + 2, value="Stock")
-
-        # Запись данных начиная с третьей строки
-        for i, entry in enumerate(data, start=3):
-            output_ws.cell(row=i, column=current_col, value=entry['SKU'])
-            output_ws.cell(row=i, column=current_col + 1, value=entry['ParserLink'])
-            output_ws.cell(row=i, column=current_col + 2, value=entry['Stock'])
-
-        logging.info(f"{Fore.GREEN}Results for pair {idx} ({sku_col}-{parser_col}) written to 'StockReady.xlsx'{Style.RESET_ALL}")
-
-        # Промежуточное сохранение после обработки текущей пары
-        if not save_workbook_with_retries(output_wb, 'StockReady.xlsx', retries=5, delay=5):
-            logging.error(f"{Fore.RED}Failed to save 'StockReady.xlsx' after multiple attempts. Exiting.{Style.RESET_ALL}")
-            sys.exit(1)  # Завершение работы скрипта, так как невозможно сохранить результаты
-
-        current_col += 3 + 1  # Три столбца данных и один пустой
-
-    # Перепроверка ссылок с ошибками
-    if failed_urls:
-        logging.info(f"{Fore.YELLOW}Reprocessing {len(failed_urls)} failed URLs...{Style.RESET_ALL}")
-        reprocess_start_time = datetime.now()
-        new_failed_urls = []
-
-        # Создание списка для перепроверки
-        reprocess_items = failed_urls.copy()
-        failed_urls.clear()  # Очистка списка для возможных новых ошибок
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            futures = []
-            for item in reprocess_items:
-                url = item['url']
-                pair_idx = item['pair_idx']
-                row = item['row']
-                sku = item['sku']
-                parser_link = item['parser_link']
-                # Выбор прокси, исключая те, которые уже имеют >=5 ошибок
-                available_proxies = [p for p in valid_proxies if p['http'] not in proxy_errors_count or proxy_errors_count[p['http']] < 5]
-                if not available_proxies:
-                    available_proxies = [None]
-                proxy = random.choice(available_proxies)
-                futures.append(executor.submit(worker, url, proxy, pair_idx, row, sku, parser_link))
-
-            for future in concurrent.futures.as_completed(futures):
-                url, count = future.result()
-                if count == "Error":
-                    error_count += 1
-                    # Добавление в список новых неудачных
-                    for item in reprocess_items:
-                        if item['url'] == url:
-                            new_failed_urls.append(item)
-                            break
-                else:
-                    # Запись результатов обратно в Excel
-                    for item in reprocess_items:
-                        if item['url'] == url:
-                            pair_idx = item['pair_idx']
-                            row = item['row']
-                            stock = count
-                            # Определение столбцов для записи
-                            sku_col, parser_col = COLUMN_PAIRS[pair_idx - 1]
-                            # Определение позиции в выходном Excel
-                            output_col = (pair_idx - 1) * 4 + 1  # 3 данных + 1 пустой
-                            output_ws.cell(row=row, column=output_col + 2, value=stock)  # Столбец "Stock"
-                            break
-
-    # Сохранение результатов перепроверки
-    if not save_workbook_with_retries(output_wb, 'StockReady.xlsx', retries=5, delay=5):
-        logging.error(f"{Fore.RED}Failed to save 'StockReady.xlsx' after reprocessing. Exiting.{Style.RESET_ALL}")
-        sys.exit(1)
+    Заголовок стоит в начале страницы, поэтому обычно хватает первых блоков.
+    feed() возвращает количество результатов, как только заголовок найден целиком,
+    иначе None. Все прочитанные байты копятся в buffer для полного разбора lxml,
+    если заголовок так и не нашёлся или в нём нет числа.
+    """
 
-    if failed_urls:
-        logging.warning(f"{Fore.RED}Reprocessing failed for {len(new_failed_urls)} URLs.{Style.RESET_ALL}")
-        # Можно повторно попытаться перепроверить их или оставить как ошибки
-    else:
-        logging.info(f"{Fore.GREEN}All failed URLs have been successfully reprocessed.{Style.RESET_ALL}")
+    def __init__(self):
+        self.buffer = bytearray()
+        self.failed = False
+        self._heading_start = None
+        self._search_from = 0
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self.failed:
+            return None
+        if self._heading_start is None:
+            marker = self.buffer.find(COUNT_HEADING_MARKER, self._search_from)
+            if marker == -1:
+                # Маркер может быть разрезан между блоками
+                self._search_from = max(0, len(self.buffer) - len(COUNT_HEADING_MARKER))
+                return None
+            self._heading_start = max(0, self.buffer.rfind(b'<h1', 0, marker))
+        match = COUNT_HEADING_PATTERN.search(self.buffer, self._heading_start)
+        if match is None:
+            return None  # Заголовок ещё не дочитан до </h1>
+        text = unescape(TAG_PATTERN.sub(b'', match.group(1)).decode('utf-8', 'replace')).strip()
+        match = RESULTS_PATTERN.search(text)
+        if match:
+            return int(match.group(1).replace(',', ''))
+        self.failed = True
+        return None
 
-    # Сохранение финального состояния Excel-файла (опционально, так как уже сохранено после каждой пары)
+def scan_result_count(response):
+    """
+    Чтение ответа блоками до заголовка с количеством результатов.
+    При неудаче дочитывает страницу и разбирает её целиком через lxml.
+    Возвращает (FetchStatus, количество, прочитано байт, время разбора).
+    """
+    scanner = ResultCountScanner()
+    parse_time = 0.0
+    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+        start = time.perf_counter()
+        count = scanner.feed(chunk)
+        parse_time += time.perf_counter() - start
+        if count is not None:
+            return FetchStatus.OK, count, len(scanner.buffer), parse_time
+    start = time.perf_counter()
+    status, count = parse_page(bytes(scanner.buffer))
+    return status, count, len(scanner.buffer), parse_time + time.perf_counter() - start
+
+def classify_response(status_code, url):
+    """
+    Итог по коду ответа и адресу после перенаправлений, None — если страницу нужно разбирать.
+    """
+    if 'captcha' in str(url).lower():
+        return FetchStatus.CAPTCHA
+    if status_code in THROTTLE_STATUSES:
+        return FetchStatus.THROTTLED
+    if status_code in NOT_FOUND_STATUSES:
+        return FetchStatus.NOT_FOUND
+    if status_code == 403:
+        return FetchStatus.BLOCKED
+    if status_code == 407:
+        return FetchStatus.PROXY_ERROR
+    if status_code >= 400:
+        return FetchStatus.HTTP_ERROR
+    return None
+
+def classify_exception(exc):
+    """
+    Итог по исключению requests или aiohttp.
+    """
+    if isinstance(exc, requests.exceptions.ProxyError):
+        return FetchStatus.PROXY_ERROR
+    if isinstance(exc, (requests.exceptions.Timeout, asyncio.TimeoutError)):
+        return FetchStatus.TIMEOUT
+    if isinstance(exc, requests.exceptions.RetryError):
+        return FetchStatus.HTTP_ERROR
+    # Ответ, оборванный посреди тела (часто ненадёжным прокси), — временная ошибка соединения
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.ContentDecodingError)):
+        return FetchStatus.CONNECTION_ERROR
+    if aiohttp is not None:
+        if isinstance(exc, (aiohttp.ClientProxyConnectionError, aiohttp.ClientHttpProxyError)):
+            return FetchStatus.PROXY_ERROR
+        if isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+            return FetchStatus.CONNECTION_ERROR
+    # Остальное (TooManyRedirects, InvalidURL и т. п.) повторять бесполезно
+    return FetchStatus.ERROR
+
+def process_product(session, url):
+    """
+    Парсинг страницы по URL и извлечение количества результатов.
+    Возвращает FetchResult; задержку заполняет вызывающий код.
+    """
     try:
-        output_wb.save('StockReady.xlsx')
-        logging.info(f"{Fore.GREEN}All results successfully saved to 'StockReady.xlsx'{Style.RESET_ALL}")
-    except PermissionError:
-        logging.error(f"{Fore.RED}PermissionError: Unable to save 'StockReady.xlsx'. Please ensure the file is not open in another program.{Style.RESET_ALL}")
+        if fast_extract:
+            # Выход из with закрывает соединение, не дочитывая остаток страницы
+            with session.get(url, timeout=TIMEOUT, stream=True) as response:
+                status = classify_response(response.status_code, response.url)
+                if status is not None:
+                    return FetchResult(status, status_code=response.status_code)
+                status, count, size, parse_time = scan_result_count(response)
+                return FetchResult(status, count, response.status_code, parse_time=parse_time, bytes=size)
+        response = session.get(url, timeout=TIMEOUT)
+        status = classify_response(response.status_code, response.url)
+        if status is not None:
+            return FetchResult(status, status_code=response.status_code, bytes=len(response.content))
+        start = time.perf_counter()
+        status, count = parse_page(response.content)
+        return FetchResult(status, count, response.status_code, parse_time=time.perf_counter() - start,
+                           bytes=len(response.content))
     except Exception as e:
-        logging.error(f"{Fore.RED}Error saving final 'StockReady.xlsx': {e}{Style.RESET_ALL}")
+        return FetchResult(classify_exception(e), error=type(e).__name__)
 
-    # Генерация общей статистики
-    try:
-        all_results = []
-        for pair_idx in range(1, len(COLUMN_PAIRS) + 1):
-            # Чтение данных из текущего столбца Stock для статистики
-            stock_col = (pair_idx - 1) * 4 + 3  # Каждая пара занимает 4 столбца (3 данных + 1 пустой)
-            for row in range(3, output_ws.max_row + 1):  # Начинаем с 3 строки, т.к. 1-ая — название, 2-ая — заголовки
-                stock = output_ws.cell(row=row, column=stock_col).value
-                if isinstance(stock, int):
-                    all_results.append(stock)
-        if all_results:
-            stats = {}
-            for count in all_results:
-                stats[count] = stats.get(count, 0) + 1
-            logging.info(f"\n{Fore.CYAN}Overall Statistics:{Style.RESET_ALL}")
-            for result, cnt in sorted(stats.items()):
+def retry_delay(attempt):
+    """
+    Пауза перед повтором номер attempt: экспоненциальный рост со случайным разбросом.
+    """
+    return RETRY_BACKOFF * 2 ** (attempt - 1) * (0.5 + random.random())
+
+class FetchHandle:
+    """
+    Связь одного запроса с fetch_hedged(): выбранный прокси, событие отправки (sent)
+    и отмена (cancel). В асинхронном движке события — asyncio.Event, отмена — через задачу.
+    """
+    __slots__ = ('proxy', 'sent', 'cancel')
+
+    def __init__(self, event=threading.Event):
+        self.proxy = None
+        self.sent = event()
+        self.cancel = event()
+
+def fetch_once(url, exclude=(), pair_idx=None, attempt=0, handle=None, deadline=None):
+    """
+    Одна загрузка ссылки через прокси от proxy_scheduler. Возвращает (FetchResult, proxy).
+    handle (FetchHandle) получает прокси и момент отправки; если handle.cancel
+    установлен до отправки, запрос не отправляется. Если место под запрос получено
+    после deadline (time.monotonic, --budget-seconds), итог — FetchStatus.DEFERRED без запроса.
+    """
+    concurrency.acquire()
+    if deadline is not None and time.monotonic() >= deadline:
+        concurrency.release()
+        if handle is not None:
+            handle.sent.set()
+        return FetchResult(FetchStatus.DEFERRED), None
+    proxy = None
+    result = FetchResult(FetchStatus.ERROR)
+    start = time.monotonic()
+    try:
+        proxy = proxy_scheduler.acquire(exclude)
+        if handle is not None:
+            handle.proxy = proxy
+        time.sleep(rate_limiter.delay(proxy))
+        start = time.monotonic()
+        with session_pool.session(proxy) as session:
+            # Задержка считается с получения сессии: ожидание свободной сессии — очередь у нас, а не медленный прокси
+            start = time.monotonic()
+            if handle is not None:
+                # Проверка после ожидания свободной сессии: к этому моменту ответ мог прийти через другой прокси
+                if handle.cancel.is_set():
+                    proxy_scheduler.cancel(proxy)
+                    result = FetchResult(FetchStatus.CANCELLED)
+                    return result, proxy
+                handle.sent.set()
+            result = process_product(session, rewrite_url(url) if rewrite_urls else url)
+    except Exception as e:
+        result = FetchResult(classify_exception(e), error=type(e).__name__)
+    finally:
+        result.latency = time.monotonic() - start
+        concurrency.release(result)
+        if handle is not None:
+            handle.sent.set()
+    # Штраф получает только прокси, через который реально шёл запрос, и только за его ошибки
+    proxy_scheduler.report(proxy, not result.proxy_fault, result.latency)
+    record_fetch(url, proxy, pair_idx, attempt, result)
+    if hedge_policy is not None and result.ok:
+        hedge_policy.observe(result.latency)
+    return result, proxy
+
+def fetch_hedged(url, exclude=(), pair_idx=None, attempt=0, deadline=None):
+    """
+    fetch_once() с запасным запросом (--hedge): если ответа нет дольше hedge_policy.delay()
+    с момента отправки, тот же запрос уходит через другой прокси и берётся первый успешный
+    ответ. Второй запрос отменяется: ещё не отправленный не уходит, уже отправленный
+    дорабатывает в hedge_executor, его ответ отбрасывается.
+    """
+    if hedge_policy is None:
+        return fetch_once(url, exclude, pair_idx, attempt, deadline=deadline)
+    handle = FetchHandle()
+    primary = hedge_executor.submit(fetch_once, url, exclude, pair_idx, attempt, handle, deadline)
+    # Ожидание места под запрос и свободной сессии в задержку не входит. Задержка берётся
+    # после отправки: первые запросы ждут места, пока копятся замеры
+    handle.sent.wait()
+    delay = hedge_policy.delay()
+    if delay is None:
+        return primary.result()
+    done, _ = concurrent.futures.wait([primary], timeout=delay)
+    if done or not hedge_policy.try_hedge():
+        return primary.result()
+    metrics.inc('stock_hedges_total', store=metrics.store(pair_idx))
+    # Запасной запрос — через любой другой прокси, кроме выбранного основным
+    handles = {primary: handle}
+    hedge_exclude = set(exclude) | ({handle.proxy['http']} if handle.proxy else set())
+    handle = FetchHandle()
+    hedge = hedge_executor.submit(fetch_once, url, hedge_exclude, pair_idx, attempt, handle)
+    handles[hedge] = handle
+    pending = set(handles)
+    winner = None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if winner is None or (future.result()[0].ok and not winner.result()[0].ok):
+                winner = future
+        if winner.result()[0].ok:
+            break
+    for future in pending:
+        future.cancel()
+        handles[future].cancel.set()
+    if winner is hedge:
+        hedge_policy.won()
+        metrics.inc('stock_hedge_wins_total', store=metrics.store(pair_idx))
+    return winner.result()
+
+def fetch_with_retries(url, pair_idx=None, deadline=None):
+    """
+    Загрузка ссылки; при временной ошибке — до retry_budget повторов с паузой,
+    каждый раз через другой прокси. Окончательные итоги (например, 404) не повторяются.
+    deadline — см. fetch_once().
+    """
+    tried = set()
+    for attempt in range(retry_budget + 1):
+        if attempt:
+            time.sleep(retry_delay(attempt))
+        result, proxy = fetch_hedged(url, tried, pair_idx, attempt, deadline)
+        if result.ok or not result.retryable:
+            break
+        if proxy:
+            tried.add(proxy['http'])
+    result.proxy = proxy_label(proxy)
+    return result
+
+def worker(url, pair_idx, row, sku, parser_link, deadline=None):
+    """
+    Рабочая функция для обработки одной ссылки через прокси от proxy_scheduler.
+    Свежий результат берётся из кэша, одинаковые ссылки загружаются один раз.
+    Возвращает (url, FetchResult). deadline — см. fetch_once().
+    """
+    key = canonicalize_url(url)
+    cached = result_cache.get(key) if result_cache is not None else None
+    if cached is not None:
+        metrics.inc('stock_cache_hits_total', store=metrics.store(pair_idx))
+        return url, FetchResult(FetchStatus.CACHED, cached)
+
+    result, leader = request_coalescer.run(key, lambda: fetch_with_retries(url, pair_idx, deadline))
+    if not leader:
+        metrics.inc('stock_coalesced_total', store=metrics.store(pair_idx))
+    if leader and result.ok and result.status is not FetchStatus.DEFERRED and result_cache is not None:
+        result_cache.put(key, result.count)
+    return url, result
+
+def verify_rewrite(links, sample_size, max_workers=MAX_THREADS):
+    """
+    Проверка rewrite_url() на случайной выборке ссылок: оригинал и переписанная ссылка
+    загружаются и должны дать одно количество результатов. Возвращает число расхождений.
+    """
+    global rewrite_urls
+    rewrite_urls = False  # Обе ссылки загружаются ровно так, как переданы
+    candidates = [(idx, item.url) for idx, urls in enumerate(links, start=1) for item in urls
+                  if rewrite_url(item.url) != item.url]
+    sample = random.sample(candidates, min(sample_size, len(candidates)))
+    logging.info(f"{Fore.GREEN}Checking URL rewrite on {len(sample)} of {len(candidates)} rewritable URLs...{Style.RESET_ALL}")
+
+    def check(idx, url):
+        return fetch_with_retries(url, idx), fetch_with_retries(rewrite_url(url), idx)
+
+    same = different = failed = 0
+    original_bytes = rewritten_bytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(check, idx, url): url for idx, url in sample}
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
+            original, rewritten = future.result()
+            if not (original.ok and rewritten.ok):
+                failed += 1
+                continue
+            original_bytes += original.bytes
+            rewritten_bytes += rewritten.bytes
+            if original.count == rewritten.count:
+                same += 1
+            else:
+                different += 1
+                logging.warning(f"{Fore.YELLOW}Rewrite changes the count: {original.count} for {url}, "
+                                f"{rewritten.count} for {rewrite_url(url)}{Style.RESET_ALL}")
+    logging.info(f"{Fore.CYAN}URL rewrite check: {same} same count, {different} different, {failed} failed to fetch; "
+                 f"page bytes {original_bytes} -> {rewritten_bytes}{Style.RESET_ALL}")
+    return different
+
+def run_threaded(tasks, max_workers=MAX_THREADS, max_inflight=None):
+    """
+    Обработка задач (LinkRecord) в пуле потоков. Отдаёт (task, url, FetchResult) по мере готовности.
+    max_workers — верхняя граница, фактическое число запросов ограничивает concurrency.
+    Задачи берутся из итератора по мере освобождения мест: в работе не больше max_inflight
+    (по умолчанию INFLIGHT_PER_WORKER на поток), поэтому память не зависит от числа ссылок.
+    """
+    tasks = iter(tasks)
+    max_inflight = max_inflight or max_workers * INFLIGHT_PER_WORKER
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        inflight = {}
+
+        def submit_next():
+            task = next(tasks, None)
+            if task is not None:
+                inflight[executor.submit(worker, task.url, task.pair_idx, task.row, task.sku, task.url,
+                                         task.deadline)] = task
+
+        for _ in range(max_inflight):
+            submit_next()
+        while inflight:
+            done, _ = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = inflight.pop(future)
+                submit_next()
+                url, result = future.result()
+                yield task, url, result
+
+async def async_process_product(session, url, proxy_url=None):
+    """
+    Асинхронный вариант process_product с теми же повторами, что и Retry в setup_session().
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(2 ** (attempt - 1))  # backoff_factor=1, как в setup_session()
+        try:
+            async with session.get(url, proxy=proxy_url) as response:
+                if response.status in (500, 502, 504) and attempt < MAX_RETRIES:
+                    continue
+                status = classify_response(response.status, response.url)
+                if status is not None:
+                    return FetchResult(status, status_code=response.status)
+                if fast_extract:
+                    scanner = ResultCountScanner()
+                    parse_time = 0.0
+                    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                        start = time.perf_counter()
+                        count = scanner.feed(chunk)
+                        parse_time += time.perf_counter() - start
+                        if count is not None:
+                            return FetchResult(FetchStatus.OK, count, response.status, parse_time=parse_time,
+                                               bytes=len(scanner.buffer))
+                    content = bytes(scanner.buffer)
+                else:
+                    parse_time = 0.0
+                    content = await response.read()
+            start = time.perf_counter()
+            status, count = parse_page(content)
+            return FetchResult(status, count, response.status, parse_time=parse_time + time.perf_counter() - start,
+                               bytes=len(content))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt < MAX_RETRIES:
+                continue
+            return FetchResult(classify_exception(e), error=type(e).__name__)
+        except Exception as e:
+            return FetchResult(classify_exception(e), error=type(e).__name__)
+    return FetchResult(FetchStatus.ERROR)
+
+async def async_fetch_once(engine, url, exclude=(), pair_idx=None, attempt=0, handle=None, deadline=None):
+    """
+    Асинхронный вариант fetch_once(). Возвращает (FetchResult, proxy).
+    Отмена задачи (--hedge) прерывает запрос, прокси не штрафуется.
+    """
+    result = FetchResult(FetchStatus.ERROR)
+    await engine.acquire_slot()
+    if deadline is not None and time.monotonic() >= deadline:
+        await engine.release_slot(None)
+        if handle is not None:
+            handle.sent.set()
+        return FetchResult(FetchStatus.DEFERRED), None
+    proxy = proxy_scheduler.acquire(exclude)
+    if handle is not None:
+        handle.proxy = proxy
+    start = time.monotonic()
+    try:
+        await asyncio.sleep(rate_limiter.delay(proxy))
+        start = time.monotonic()
+        if handle is not None:
+            handle.sent.set()
+        fetch_url = rewrite_url(url) if rewrite_urls else url
+        result = await async_process_product(engine.session_for(proxy), fetch_url, proxy['http'] if proxy else None)
+    except asyncio.CancelledError:
+        result = FetchResult(FetchStatus.CANCELLED)
+        raise
+    finally:
+        result.latency = time.monotonic() - start
+        if handle is not None:
+            handle.sent.set()
+        await engine.release_slot(result)
+        if result.status is FetchStatus.CANCELLED:
+            proxy_scheduler.cancel(proxy)
+        else:
+            proxy_scheduler.report(proxy, not result.proxy_fault, result.latency)
+            record_fetch(url, proxy, pair_idx, attempt, result)
+            if hedge_policy is not None and result.ok:
+                hedge_policy.observe(result.latency)
+    return result, proxy
+
+async def async_fetch_hedged(engine, url, exclude=(), pair_idx=None, attempt=0, deadline=None):
+    """
+    Асинхронный вариант fetch_hedged(): проигравший запрос отменяется сразу.
+    """
+    if hedge_policy is None:
+        return await async_fetch_once(engine, url, exclude, pair_idx, attempt, deadline=deadline)
+    handle = FetchHandle(asyncio.Event)
+    primary = asyncio.ensure_future(async_fetch_once(engine, url, exclude, pair_idx, attempt, handle, deadline))
+    # Ожидание места под запрос в задержку не входит, задержка берётся после отправки
+    await handle.sent.wait()
+    delay = hedge_policy.delay()
+    if delay is None:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not hedge_policy.try_hedge():
+        return await primary
+    metrics.inc('stock_hedges_total', store=metrics.store(pair_idx))
+    hedge_exclude = set(exclude) | ({handle.proxy['http']} if handle.proxy else set())
+    hedge = asyncio.ensure_future(async_fetch_once(engine, url, hedge_exclude, pair_idx, attempt))
+    pending = {primary, hedge}
+    winner = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if winner is None or (task.result()[0].ok and not winner.result()[0].ok):
+                    winner = task
+            if winner.result()[0].ok:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+    if winner is hedge:
+        hedge_policy.won()
+        metrics.inc('stock_hedge_wins_total', store=metrics.store(pair_idx))
+    return winner.result()
+
+async def async_fetch_with_retries(engine, url, pair_idx=None, deadline=None):
+    """
+    Асинхронный вариант fetch_with_retries().
+    """
+    tried = set()
+    for attempt in range(retry_budget + 1):
+        if attempt:
+            await asyncio.sleep(retry_delay(attempt))
+        result, proxy = await async_fetch_hedged(engine, url, tried, pair_idx, attempt, deadline)
+        if result.ok or not result.retryable:
+            break
+        if proxy:
+            tried.add(proxy['http'])
+    result.proxy = proxy_label(proxy)
+    return result
+
+async def async_worker(engine, url, pair_idx, row, sku, parser_link, deadline=None):
+    """
+    Асинхронная рабочая функция. Возвращает то же (url, result), что и worker().
+    engine — AsyncFetchEngine: сессии aiohttp по прокси, места под запросы и
+    словарь загрузок в процессе (ключ -> asyncio.Future) для объединения запросов.
+    """
+    key = canonicalize_url(url)
+    cached = result_cache.get(key) if result_cache is not None else None
+    if cached is not None:
+        metrics.inc('stock_cache_hits_total', store=metrics.store(pair_idx))
+        return url, FetchResult(FetchStatus.CACHED, cached)
+
+    inflight = engine.inflight
+    pending = inflight.get(key)
+    leader = pending is None
+    if leader:
+        pending = asyncio.get_running_loop().create_future()
+        inflight[key] = pending
+        result = FetchResult(FetchStatus.ERROR)
+        try:
+            result = await async_fetch_with_retries(engine, url, pair_idx, deadline)
+        finally:
+            del inflight[key]
+            pending.set_result(result)
+    else:
+        metrics.inc('stock_coalesced_total', store=metrics.store(pair_idx))
+        result = await asyncio.shield(pending)
+
+    if leader and result.ok and result.status is not FetchStatus.DEFERRED and result_cache is not None:
+        result_cache.put(key, result.count)
+    return url, result
+
+_ENGINE_DONE = object()
+
+class AsyncFetchEngine:
+    """
+    Асинхронный движок загрузки на aiohttp.
+
+    Цикл событий работает в отдельном потоке и живёт между вызовами run(),
+    поэтому сессии и соединения через каждый прокси переиспользуются.
+    Для каждого прокси создаётся своя сессия с ограничением числа соединений.
+    """
+
+    def __init__(self, max_concurrency=ASYNC_MAX_CONCURRENCY, per_proxy_limit=ASYNC_PER_PROXY_LIMIT,
+                 idle_timeout=SESSION_IDLE_TIMEOUT):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is not installed. Run 'pip install aiohttp' or use --engine threads.")
+        self.max_concurrency = max_concurrency
+        self.per_proxy_limit = per_proxy_limit
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self.inflight = {}
+        self._slots = None  # asyncio.Condition, создаётся в цикле событий
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-fetch-engine", daemon=True)
+        self._thread.start()
+
+    def session_for(self, proxy):
+        key = proxy['http'] if proxy else None
+        session = self._sessions.get(key)
+        if session is None:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.per_proxy_limit,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=self.idle_timeout,
+                ),
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+                headers={
+                    "User-Agent": random.choice(USER_AGENTS),
+                    "Accept-Language": "en-US,en;q=0.9",
+                    # br не указываем: aiohttp распаковывает его только при установленном brotli
+                    "Accept-Encoding": "gzip, deflate",
+                },
+            )
+            self._sessions[key] = session
+        return session
+
+    async def acquire_slot(self):
+        """
+        Ожидание места под запрос в пределах concurrency.limit.
+        """
+        async with self._slots:
+            await self._slots.wait_for(concurrency.try_acquire)
+
+    async def release_slot(self, result):
+        concurrency.release(result)
+        async with self._slots:
+            self._slots.notify_all()
+
+    async def _run_all(self, tasks, results):
+        try:
+            if self._slots is None:
+                self._slots = asyncio.Condition()
+            tasks = iter(tasks)
+
+            # max_concurrency исполнителей разбирают общий итератор задач: корутины
+            # создаются не на каждую ссылку, а задачи читаются по мере освобождения мест
+            async def drain():
+                for task in tasks:
+                    url, result = await async_worker(self, task.url, task.pair_idx, task.row, task.sku, task.url,
+                                                     task.deadline)
+                    results.put((task, url, result))
+
+            await asyncio.gather(*(drain() for _ in range(self.max_concurrency)))
+        finally:
+            results.put(_ENGINE_DONE)
+
+    def run(self, tasks):
+        """
+        Обработка задач (LinkRecord). Отдаёт (task, url, FetchResult) по мере готовности.
+        """
+        results = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._run_all(tasks, results), self._loop)
+        while True:
+            item = results.get()
+            if item is _ENGINE_DONE:
+                break
+            yield item
+        future.result()
+
+    async def _close_sessions(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close_sessions(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+class RunJournal:
+    """
+    Append-only журнал успешно обработанных ссылок в формате JSONL.
+
+    Каждая строка — {"pair_idx", "row", "url", "stock"}; запись идёт сразу по мере
+    готовности результатов, поэтому после падения процесса работу можно продолжить
+    с --resume. Ошибки не записываются и при продолжении проверяются заново.
+    """
+
+    FSYNC_EVERY = 100  # Сброс на диск (fsync) раз в столько записей
+
+    def __init__(self, path=JOURNAL_FILE, resume=False):
+        self.path = path
+        self.completed = self.load(path) if resume else {}
+        self._unsynced = 0
+        if resume and os.path.exists(path):
+            self._file = open(path, 'a', encoding='utf-8')
+            # Последняя строка могла оборваться при падении — начинаем с новой
+            if os.path.getsize(path) and not self._ends_with_newline(path):
+                self._file.write('\n')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    @staticmethod
+    def load(path):
+        """
+        Чтение журнала: {(pair_idx, row): (url, stock)}. Повреждённые строки пропускаются.
+        """
+        completed = {}
+        if not os.path.exists(path):
+            return completed
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    completed[(record['pair_idx'], record['row'])] = (record['url'], record['stock'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return completed
+
+    def record(self, pair_idx, row, url, stock):
+        self._file.write(json.dumps({'pair_idx': pair_idx, 'row': row, 'url': url, 'stock': stock}) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.FSYNC_EVERY:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+class RunHistory:
+    """
+    История результатов запуска по столбцам: магазин, SKU, ссылка, количество,
+    итог загрузки, задержка, прокси и время. Сохраняется в Parquet, по файлу на запуск
+    (нужен pyarrow), чтобы статистику и тренды считать в pandas без разбора xlsx.
+    """
+
+    OBJECT_COLUMNS = ('store', 'sku', 'url', 'status', 'proxy')
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        # Строковые столбцы — списки ссылок на уже существующие строки (LinkRecord, FetchStatus),
+        # числовые — массивы array без отдельного объекта на каждое значение
+        self._columns = {name: [] for name in self.OBJECT_COLUMNS}
+        self._stock = array('q')
+        self._latency = array('d')
+        self._time = array('d')
+
+    def add(self, store, sku, url, stock, status, latency=None, proxy=None):
+        columns = self._columns
+        columns['store'].append(store)
+        columns['sku'].append(sku)
+        columns['url'].append(url)
+        columns['status'].append(status)
+        columns['proxy'].append(proxy)
+        self._stock.append(ResultStore.MISSING if stock is None else stock)
+        self._latency.append(math.nan if latency is None else latency)
+        self._time.append(time.time())
+
+    def __len__(self):
+        return len(self._stock)
+
+    def frame(self):
+        """
+        DataFrame запуска; ошибки — пустое значение stock.
+        """
+        columns = self._columns
+        stock = np.frombuffer(self._stock, dtype=np.int64) if self._stock else np.empty(0, dtype=np.int64)
+        return pd.DataFrame({
+            'run': pd.Series(self.run_id, index=range(len(self)), dtype='string'),
+            'store': pd.Series(columns['store'], dtype='string'),
+            # SKU в Stock_All.xlsx бывают и числами, в истории они строки
+            'sku': pd.Series([None if sku is None else str(sku) for sku in columns['sku']], dtype='string'),
+            'url': pd.Series(columns['url'], dtype='string'),
+            'stock': pd.Series(pd.arrays.IntegerArray(stock.copy(), stock == ResultStore.MISSING)),
+            'status': pd.Series(columns['status'], dtype='string'),
+            'latency': pd.Series(np.array(self._latency, dtype=np.float32)),
+            'proxy': pd.Series(columns['proxy'], dtype='string'),
+            'time': pd.Series(pd.to_datetime(np.array(self._time, dtype=np.float64), unit='s')),
+        })
+
+    def save(self, directory=HISTORY_DIR, name=None):
+        """
+        Запись запуска в {directory}/run_{run_id}.parquet. Возвращает путь.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name or f"run_{self.run_id}.parquet")
+        self.frame().to_parquet(path, index=False)
+        return path
+
+def history_report(directory=HISTORY_DIR, top=HISTORY_TOP):
+    """
+    Отчёт по всей истории запусков: итоги запусков, ссылки, которые чаще всего
+    переходят между «есть в наличии» и «нет», и прокси, у которых растёт доля ошибок.
+    """
+    try:
+        history = pd.read_parquet(directory)
+    except (ImportError, OSError, ValueError) as e:
+        logging.error(f"{Fore.RED}Error reading run history '{directory}': {e}{Style.RESET_ALL}")
+        return
+    if history.empty:
+        logging.warning(f"{Fore.YELLOW}Run history '{directory}' is empty.{Style.RESET_ALL}")
+        return
+    history['failed'] = history['stock'].isna()
+    history['in_stock'] = history['stock'].gt(0).astype('float32')  # У ошибок — NaN
+
+    runs = history.groupby('run').agg(started=('time', 'min'), urls=('url', 'size'), errors=('failed', 'sum'),
+                                      in_stock=('in_stock', 'mean'), latency=('latency', 'median'))
+    logging.info(f"\n{Fore.CYAN}Runs ({len(runs)}):{Style.RESET_ALL}\n{runs.sort_values('started').tail(top).to_string()}")
+
+    # Переходы наличия между соседними запусками одной ссылки (ошибки не считаются)
+    known = history.loc[~history['failed'], ['store', 'sku', 'url', 'time', 'in_stock']].sort_values('time', kind='stable')
+    previous = known.groupby(['store', 'url'])['in_stock'].shift()
+    known['flip'] = previous.notna() & known['in_stock'].ne(previous)
+    flips = known.groupby(['store', 'sku', 'url'])['flip'].sum()
+    flips = flips[flips > 0].nlargest(top)
+    if flips.empty:
+        logging.info(f"\n{Fore.CYAN}No listing changed availability between runs.{Style.RESET_ALL}")
+    else:
+        logging.info(f"\n{Fore.CYAN}Listings that flip most often:{Style.RESET_ALL}\n{flips.to_string()}")
+
+    # Доля ошибок по прокси: последний запуск против среднего по предыдущим
+    fetched = history[history['proxy'].notna() & history['proxy'].ne('direct')]
+    if fetched.empty:
+        return
+    rates = fetched.pivot_table(index='proxy', columns='run', values='failed', aggfunc='mean')
+    order = runs.sort_values('started').index
+    rates = rates[[run for run in order if run in rates.columns]]
+    proxies = pd.DataFrame({'last_error_rate': rates.iloc[:, -1]})
+    proxies['earlier_error_rate'] = rates.iloc[:, :-1].mean(axis=1) if rates.shape[1] > 1 else float('nan')
+    proxies['change'] = proxies['last_error_rate'] - proxies['earlier_error_rate']
+    proxies['latency'] = fetched.groupby('proxy')['latency'].median()
+    proxies = proxies.sort_values('change', ascending=False, na_position='last').head(top)
+    logging.info(f"\n{Fore.CYAN}Proxies by error rate change:{Style.RESET_ALL}\n{proxies.round(3).to_string()}")
+
+class LinkRecord:
+    """
+    Одна ссылка из Stock_All.xlsx: номер пары столбцов, строка, SKU и ParserLink.
+    """
+    __slots__ = ('pair_idx', 'row', 'sku', 'url')
+    deadline = None  # Обязательная ссылка загружается при любом бюджете
+
+    def __init__(self, pair_idx, row, sku, url):
+        self.pair_idx = pair_idx
+        self.row = row
+        self.sku = sku
+        self.url = url
+
+class DeferrableLink(LinkRecord):
+    """
+    Необязательная ссылка plan_fetches() под --budget-seconds: если место под запрос
+    освободилось после deadline, она откладывается, а не загружается.
+    Создаётся только для выданных задач, список ссылок остаётся из LinkRecord.
+    """
+    __slots__ = ('deadline',)
+
+    def __init__(self, item, deadline):
+        super().__init__(item.pair_idx, item.row, item.sku, item.url)
+        self.deadline = deadline
+
+class ResultStore:
+    """
+    Компактные результаты по ключу (pair_idx, row): на каждую пару массив array('q'),
+    индекс — номер строки Stock_All.xlsx, MISSING — результата нет.
+    Около 8 байт на строку вместо ~200 у словаря с ключами-кортежами.
+    Поддерживает то, что нужно от словаря: get, [key] = stock, in, len, items, values.
+    """
+
+    MISSING = -1
+
+    def __init__(self, pairs=None):
+        self._arrays = {}
+        self._count = 0
+        # Массивы сразу нужной длины: при записи из разных потоков они не растут
+        for idx, pair in (pairs or {}).items():
+            if pair['urls']:
+                self._array(idx, max(item.row for item in pair['urls']))
+
+    def _array(self, pair_idx, row):
+        values = self._arrays.get(pair_idx)
+        if values is None:
+            values = self._arrays[pair_idx] = array('q')
+        if row >= len(values):
+            values.extend([self.MISSING] * (row + 1 - len(values)))
+        return values
+
+    def __setitem__(self, key, stock):
+        pair_idx, row = key
+        values = self._array(pair_idx, row)
+        if values[row] == self.MISSING:
+            self._count += 1
+        values[row] = stock
+
+    def get(self, key, default=None):
+        pair_idx, row = key
+        values = self._arrays.get(pair_idx)
+        if values is None or row >= len(values) or values[row] == self.MISSING:
+            return default
+        return values[row]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._count
+
+    def items(self):
+        for pair_idx, values in self._arrays.items():
+            for row, stock in enumerate(values):
+                if stock != self.MISSING:
+                    yield (pair_idx, row), stock
+
+    def values(self):
+        for _, stock in self.items():
+            yield stock
+
+    def copy(self):
+        store = ResultStore()
+        store._arrays = {pair_idx: array('q', values) for pair_idx, values in self._arrays.items()}
+        store._count = self._count
+        return store
+
+def plan_fetches(items, url_history, fallback, max_staleness=MAX_STALENESS, budget=0):
+    """
+    Порядок проверки ссылок по UrlHistory. Обязательные: новые и не проверявшиеся дольше
+    max_staleness секунд. Остальные — по убыванию ожидаемого числа изменений с прошлой
+    проверки: (changes + 1) / (checks + 2) изменений на проверку, умноженное на возраст.
+    При budget > 0 (запросов) необязательные сверх бюджета откладываются.
+    Последнее значение каждой известной ссылки записывается в fallback.
+    Возвращает списки LinkRecord (mandatory, optional, deferred).
+    """
+    now = time.time()
+    mandatory = []
+    scored = []
+    for item in items:
+        state = url_history.get(canonicalize_url(item.url))
+        if state is None:
+            mandatory.append(item)
+            continue
+        last_stock, fetched_at, _, changes, checks = state
+        fallback[(item.pair_idx, item.row)] = last_stock
+        age = now - fetched_at
+        if age >= max_staleness:
+            mandatory.append(item)
+        else:
+            scored.append(((changes + 1) / (checks + 2) * age, item))
+    scored.sort(key=lambda entry: entry[0], reverse=True)
+    optional = [item for _, item in scored]
+    deferred = []
+    if budget:
+        room = max(budget - len(mandatory), 0)
+        optional, deferred = optional[:room], optional[room:]
+    return mandatory, optional, deferred
+
+def budgeted_tasks(mandatory, optional, deadline=None, late=None):
+    """
+    Задачи по порядку plan_fetches. После deadline (time.monotonic) необязательные ссылки
+    больше не выдаются и попадают в late, обязательные выдаются всегда. Уже выданные
+    необязательные несут deadline: движки берут задачи заранее, и те, что дождались
+    места под запрос слишком поздно, возвращаются с FetchStatus.DEFERRED.
+    """
+    yield from mandatory
+    for position, item in enumerate(optional):
+        if deadline is not None and time.monotonic() >= deadline:
+            late.extend(optional[position:])
+            return
+        yield item if deadline is None else DeferrableLink(item, deadline)
+
+def with_deferred(completed, deferred, late, fallback):
+    """
+    Результаты загрузки вместе с отложенными ссылками: у них FetchStatus.DEFERRED
+    и последнее известное значение из fallback.
+    """
+    for item in deferred:
+        yield item, item.url, FetchResult(FetchStatus.DEFERRED, fallback.get((item.pair_idx, item.row)))
+    for task, url, result in completed:
+        if result.status is FetchStatus.DEFERRED:
+            # Отложено движком по --budget-seconds: значение из прошлой проверки
+            result.count = fallback.get((task.pair_idx, task.row))
+        yield task, url, result
+    for item in late:
+        yield item, item.url, FetchResult(FetchStatus.DEFERRED, fallback.get((item.pair_idx, item.row)))
+
+def schedule_tasks(items, url_history, args):
+    """
+    Задачи и обёртка результатов для одного прохода: без UrlHistory — исходный порядок,
+    иначе порядок plan_fetches с бюджетом --budget-requests и --budget-seconds.
+    """
+    if url_history is None:
+        return items, lambda completed: completed
+    fallback = ResultStore()
+    mandatory, optional, deferred = plan_fetches(items, url_history, fallback, args.max_staleness, args.budget_requests)
+    logging.info(f"{Fore.GREEN}Fetch plan: {len(mandatory)} new or stale URLs, {len(optional)} by volatility, "
+                 f"{len(deferred)} deferred by the request budget.{Style.RESET_ALL}")
+    deadline = time.monotonic() + args.budget_seconds if args.budget_seconds else None
+    late = []
+    return budgeted_tasks(mandatory, optional, deadline, late), lambda completed: with_deferred(completed, deferred, late, fallback)
+
+def load_links(filename=STOCK_ALL_FILE):
+    """
+    Чтение Stock_All.xlsx за один проход в режиме read_only.
+
+    Возвращает (store_names, links): названия магазинов из первой строки
+    и для каждой пары COLUMN_PAIRS список LinkRecord (данные с третьей строки).
+    """
+    columns = [
+        (column_index_from_string(sku_col) - 1, column_index_from_string(parser_col) - 1)
+        for sku_col, parser_col in COLUMN_PAIRS
+    ]
+    store_names = [None] * len(COLUMN_PAIRS)
+    links = [[] for _ in COLUMN_PAIRS]
+    workbook = load_workbook(filename=filename, read_only=True)
+    try:
+        for row, values in enumerate(workbook.active.iter_rows(values_only=True), start=1):
+            width = len(values)
+            if row == 1:
+                store_names = [values[sku] if sku < width else None for sku, _ in columns]
+            elif row >= 3:
+                for pair_idx, (sku, parser) in enumerate(columns, start=1):
+                    url = values[parser] if parser < width else None
+                    if url and isinstance(url, str):
+                        links[pair_idx - 1].append(LinkRecord(pair_idx, row, values[sku] if sku < width else None, url))
+    finally:
+        workbook.close()
+    return store_names, links
+
+def build_output_workbook(pairs, results):
+    """
+    Сборка StockReady.xlsx в режиме write_only, строка за строкой.
+    results — количество результатов по ключу (pair_idx, row), отсутствующие пишутся как "Error".
+
+    Каждая пара занимает 4 столбца (SKU, ParserLink, Stock и пустой), в первой строке —
+    объединённая ячейка с названием магазина, во второй — заголовки.
+    Пары без ссылок остаются пустыми столбцами.
+    """
+    output_wb = Workbook(write_only=True)
+    output_ws = output_wb.create_sheet("StockReady")
+    width = len(COLUMN_PAIRS) * 4 - 1
+
+    names_row = [None] * width
+    headers_row = [None] * width
+    for idx, pair in pairs.items():
+        current_col = (idx - 1) * 4  # Индекс с нуля первого столбца пары
+        names_row[current_col] = pair['store_name']
+        headers_row[current_col:current_col + 3] = ["SKU", "ParserLink", "Stock"]
+        output_ws.merged_cells.add(f"{get_column_letter(current_col + 1)}1:{get_column_letter(current_col + 3)}1")
+    output_ws.append(names_row)
+    output_ws.append(headers_row)
+
+    # Запись данных начиная с третьей строки
+    max_len = max((len(pair['urls']) for pair in pairs.values()), default=0)
+    for i in range(max_len):
+        row_values = [None] * width
+        for idx, pair in pairs.items():
+            if i < len(pair['urls']):
+                item = pair['urls'][i]
+                current_col = (idx - 1) * 4
+                row_values[current_col:current_col + 3] = [item.sku, item.url, results.get((idx, item.row), "Error")]
+        output_ws.append(row_values)
+    return output_wb
+
+def save_workbook_with_retries(build_workbook, filename='StockReady.xlsx', retries=5, delay=5):
+    """
+    Попытка сохранить рабочую книгу с повторными попытками при ошибках.
+    Книга write_only сохраняется только один раз, поэтому на каждую попытку
+    она собирается заново через build_workbook().
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            start = time.perf_counter()
+            build_workbook().save(filename)
+            metrics.inc('stock_stage_seconds_total', time.perf_counter() - start, stage='save')
+            logging.info(f"{Fore.GREEN}Workbook saved successfully to '{filename}'.{Style.RESET_ALL}")
+            return True
+        except PermissionError:
+            logging.error(f"{Fore.RED}PermissionError: Unable to save '{filename}'. Attempt {attempt} of {retries}. Ensure the file is closed.{Style.RESET_ALL}")
+            if attempt < retries:
+                logging.info(f"{Fore.YELLOW}Retrying in {delay} seconds...{Style.RESET_ALL}")
+                time.sleep(delay)
+            else:
+                logging.error(f"{Fore.RED}Failed to save '{filename}' after {retries} attempts. Exiting.{Style.RESET_ALL}")
+                return False
+        except Exception as e:
+            logging.error(f"{Fore.RED}Error saving '{filename}': {e}{Style.RESET_ALL}")
+            return False
+    return False
+
+def build_pairs(store_names, links):
+    """
+    Описание пар столбцов со ссылками: {номер пары: {'columns', 'store_name', 'urls', 'processed'}}.
+    Пары без ссылок пропускаются.
+    """
+    pairs = {}
+    for idx, (sku_col, parser_col) in enumerate(COLUMN_PAIRS, start=1):
+        urls = links[idx - 1]
+        logging.info(f"{Fore.GREEN}Loaded {len(urls)} URLs from columns {sku_col}-{parser_col} in 'Stock_All.xlsx'{Style.RESET_ALL}")
+        if not urls:
+            # При отсутствии данных для данной пары, оставляем пустые столбцы
+            logging.warning(f"{Fore.YELLOW}No URLs found in columns {sku_col}-{parser_col}. Skipping this pair.{Style.RESET_ALL}")
+            continue
+
+        # Получение названия магазина из первой строки соответствующего столбца SKU
+        store_name = store_names[idx - 1]
+        if not store_name:
+            store_name = f"Store_{idx}"  # Если название не найдено, использовать дефолтное
+            logging.warning(f"{Fore.YELLOW}Store name not found in cell {sku_col}1. Using default name '{store_name}'.{Style.RESET_ALL}")
+        else:
+            logging.info(f"{Fore.BLUE}Store name for pair {idx}: {store_name}{Style.RESET_ALL}")
+
+        metrics.stores[idx] = store_name
+        pairs[idx] = {
+            'columns': f"{sku_col}-{parser_col}",
+            'store_name': store_name,
+            'urls': urls,
+            'processed': 0,
+        }
+    return pairs
+
+def shard_of(pair_idx, row, shard_count, shard_by='hash'):
+    """
+    Номер шарда (с 1) для ссылки: по магазину или по хэшу (pair_idx, row).
+    Хэш не зависит от процесса и машины, поэтому шарды совпадают при запуске на разных машинах.
+    """
+    if shard_by == 'store':
+        return (pair_idx - 1) % shard_count + 1
+    digest = hashlib.sha1(f"{pair_idx}:{row}".encode('ascii')).digest()
+    return int.from_bytes(digest[:4], 'big') % shard_count + 1
+
+def shard_path(path, shard_index, shard_count):
+    """
+    Имя файла шарда: run_journal.jsonl -> run_journal.shard2of4.jsonl.
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_index}of{shard_count}{ext}"
+
+def merge_shard_outputs(paths, pairs):
+    """
+    Сборка результатов из журналов шардов в ResultStore.
+
+    Файлы обходятся в отсортированном порядке, при повторе ключа остаётся первый результат;
+    записи, чья ссылка не совпадает с текущим Stock_All.xlsx, отбрасываются.
+    """
+    expected = {(idx, item.row): item.url for idx, pair in pairs.items() for item in pair['urls']}
+    results = ResultStore(pairs)
+    for path in sorted(paths):
+        if not os.path.exists(path):
+            logging.warning(f"{Fore.YELLOW}Shard output '{path}' not found, its URLs are left as errors.{Style.RESET_ALL}")
+            continue
+        for key, (url, stock) in RunJournal.load(path).items():
+            if key not in results and expected.get(key) == url:
+                results[key] = stock
+    return results
+
+def run_shard(args):
+    """
+    Точка входа процесса пула для одного шарда.
+    """
+    main(args)
+
+def run_sharded(args):
+    """
+    Запуск --shards шардов в пуле процессов. Возвращает пути журналов шардов.
+    """
+    children = []
+    for shard_index in range(1, args.shards + 1):
+        child = argparse.Namespace(**vars(args))
+        child.shards = 1
+        child.shard_index = shard_index
+        child.shard_count = args.shards
+        child.no_progress = True  # Строки прогресса нескольких процессов перемешались бы
+        children.append(child)
+    logging.info(f"{Fore.GREEN}Running {args.shards} shards (by {args.shard_by}) in separate processes...{Style.RESET_ALL}")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.shards) as executor:
+        futures = {executor.submit(run_shard, child): child for child in children}
+        for future in concurrent.futures.as_completed(futures):
+            child = futures[future]
+            try:
+                future.result()
+                logging.info(f"{Fore.GREEN}Shard {child.shard_index}/{child.shard_count} finished.{Style.RESET_ALL}")
+            except Exception as e:
+                logging.error(f"{Fore.RED}Shard {child.shard_index}/{child.shard_count} failed: {e}{Style.RESET_ALL}")
+    return [shard_path(args.journal, child.shard_index, child.shard_count) for child in children]
+
+def write_stock_ready(pairs, results):
+    """
+    Единственная запись StockReady.xlsx из результатов в памяти.
+    """
+    if not save_workbook_with_retries(lambda: build_output_workbook(pairs, results), 'StockReady.xlsx', retries=5, delay=5):
+        logging.error(f"{Fore.RED}Failed to save 'StockReady.xlsx' after multiple attempts. Exiting.{Style.RESET_ALL}")
+        sys.exit(1)
+    logging.info(f"{Fore.GREEN}All results successfully saved to 'StockReady.xlsx'{Style.RESET_ALL}")
+
+def write_store_upload(pairs, pair_idx, results, output_dir=UPLOAD_DIR, snapshot=None):
+    """
+    Файл загрузки одного магазина прямо из результатов в памяти, без StockReady.xlsx.
+    Строки те же, что в StockReady.xlsx, отсутствующие результаты идут как "Error".
+    С snapshot (--delta) в файл попадают только изменившиеся SKU.
+    """
+    pair = pairs[pair_idx]
+    entries = ((item.sku, results.get((pair_idx, item.row), "Error")) for item in pair['urls'])
+    # Номер магазина по порядку столбцов SKU, как в create_upload_files
+    write_upload_file(pair['store_name'], entries, output_dir, list(pairs).index(pair_idx) + 1, snapshot)
+
+def report_results(stock, error_count):
+    """
+    Общая статистика по результатам. stock — Series количеств результатов (ошибки пустые).
+    """
+    # Частоты считаются в pandas одним вызовом value_counts
+    try:
+        stats = stock.dropna().astype('int64').value_counts().sort_index()
+        if not stats.empty:
+            logging.info(f"\n{Fore.CYAN}Overall Statistics:{Style.RESET_ALL}")
+            for result, cnt in stats.items():
                 if result == 1:
                     logging.info(f"{Fore.MAGENTA}{cnt} продукт(ов) имеют 1 результат{Style.RESET_ALL}")
                 elif result == 0:
@@ -498,21 +2441,791 @@ def main():
 
     logging.info(f"\n{Fore.CYAN}Processing completed. Total errors: {error_count}{Style.RESET_ALL}")
 
-    # Добавлено: Ожидание 10 секунд с отсчетом и запуск второго скрипта
-    logging.info(f"{Fore.YELLOW}Waiting for 10 seconds before starting uploadFileCreation.py...{Style.RESET_ALL}")
-    for remaining in range(10, 0, -1):
-        sys.stdout.write(f"\r{Fore.YELLOW}Starting in {remaining} seconds...{Style.RESET_ALL}")
-        sys.stdout.flush()
-        time.sleep(1)
-    print()  # Перенос строки после отсчета
-    logging.info(f"{Fore.YELLOW}Launching uploadFileCreation.py...{Style.RESET_ALL}")
+class StockService:
+    """
+    Состояние режима --daemon: пары столбцов из Stock_All.xlsx и последние результаты в памяти.
+    Цикл перепроверки пишет результаты, HTTP-сервер читает их под той же блокировкой.
+    Результат ссылки, упавшей в очередном цикле, остаётся прежним.
+    """
+
+    def __init__(self, args, path=STOCK_ALL_FILE):
+        self.args = args
+        self.path = path
+        self.lock = threading.Lock()
+        self.pairs = {}
+        self.results = ResultStore()
+        self.mtime = None
+        self.cycle = 0
+        self.updated = None
+        self.refresh = threading.Event()  # Внеочередной цикл: POST /refresh
+        self.write_lock = threading.Lock()  # Файлы пишут и цикл, и POST /export
+
+    def changed(self):
+        try:
+            return os.path.getmtime(self.path) != self.mtime
+        except OSError:
+            return False
+
+    def load(self, store_names=None, links=None):
+        """
+        (Пере)загрузка ссылок. Результаты строк, где ссылка не изменилась, сохраняются.
+        """
+        self.mtime = os.path.getmtime(self.path)
+        if links is None:
+            store_names, links = load_links(self.path)
+        pairs = build_pairs(store_names, links)
+        results = ResultStore(pairs)
+        with self.lock:
+            old_urls = {(idx, item.row): item.url for idx, pair in self.pairs.items() for item in pair['urls']}
+            for idx, pair in pairs.items():
+                for item in pair['urls']:
+                    stock = self.results.get((idx, item.row))
+                    if stock is not None and old_urls.get((idx, item.row)) == item.url:
+                        results[(idx, item.row)] = stock
+            self.results = results
+            self.pairs = pairs
+        total = sum(len(pair['urls']) for pair in pairs.values())
+        logging.info(f"{Fore.GREEN}Loaded {total} URLs from '{self.path}', {len(results)} known results kept.{Style.RESET_ALL}")
+
+    def record(self, pair_idx, row, stock):
+        with self.lock:
+            self.results[(pair_idx, row)] = stock
+
+    def snapshot(self):
+        """
+        Копии пар и результатов для чтения без блокировки.
+        """
+        with self.lock:
+            return self.pairs, self.results.copy()
+
+    def find_pair(self, store):
+        """
+        Номер пары по названию магазина (пробелы не учитываются, как в именах файлов загрузки).
+        """
+        pairs, _ = self.snapshot()
+        for ordinal, (idx, pair) in enumerate(pairs.items(), start=1):
+            if sanitize_store_name(pair['store_name'], ordinal) == sanitize_store_name(store, ordinal):
+                return idx
+        return None
+
+    def stock(self, store=None):
+        pairs, results = self.snapshot()
+        selected = [self.find_pair(store)] if store else list(pairs)
+        return {
+            'cycle': self.cycle,
+            'updated': self.updated,
+            'stores': [{
+                'store': pairs[idx]['store_name'],
+                'items': [{'sku': item.sku, 'url': item.url, 'stock': results.get((idx, item.row))}
+                          for item in pairs[idx]['urls']],
+            } for idx in selected if idx is not None],
+        }
+
+    def upload_text(self, store):
+        """
+        Содержимое файла загрузки магазина из текущих результатов или None, если магазина нет.
+        """
+        idx = self.find_pair(store)
+        if idx is None:
+            return None
+        pairs, results = self.snapshot()
+        buffer = io.StringIO()
+        write_upload_lines(buffer, ((item.sku, results.get((idx, item.row), "Error")) for item in pairs[idx]['urls']))
+        return buffer.getvalue()
+
+    def export(self):
+        """
+        Запись StockReady.xlsx (если не --no-excel) и всех файлов загрузки из текущих результатов.
+        """
+        pairs, results = self.snapshot()
+        written = {}
+        if not self.args.no_excel:
+            with self.write_lock:
+                ok = save_workbook_with_retries(lambda: build_output_workbook(pairs, results), 'StockReady.xlsx',
+                                                retries=1, delay=0)
+            written['excel'] = 'StockReady.xlsx' if ok else None
+        written['uploads'] = self.args.upload_dir
+        with self.write_lock:
+            for idx in pairs:
+                write_store_upload(pairs, idx, results, self.args.upload_dir)
+        return written
+
+class StockRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP-интерфейс режима --daemon:
+    GET /stock[?store=...], GET /upload/<магазин>.txt, GET /metrics, GET /status,
+    POST /refresh (внеочередной цикл), POST /export (StockReady.xlsx и файлы загрузки на диск).
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False, default=str)
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', f"{content_type}; charset=utf-8")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = urlsplit(self.path)
+        query = dict(parse_qsl(parts.query))
+        if parts.path == '/stock':
+            store = query.get('store')
+            if store and service.find_pair(store) is None:
+                self._send(404, {'error': f"unknown store {store}"})
+            else:
+                self._send(200, service.stock(store))
+        elif parts.path.startswith('/upload/') and parts.path.endswith('.txt'):
+            # /upload/<магазин>.txt или /upload/upload_<магазин>.txt, как имя файла загрузки
+            store = unquote(parts.path[len('/upload/'):-len('.txt')])
+            text = service.upload_text(store[len('upload_'):] if store.startswith('upload_') else store)
+            if text is None:
+                self._send(404, {'error': f"unknown store {store}"})
+            else:
+                self._send(200, text, 'text/plain')
+        elif parts.path == '/metrics':
+            self._send(200, metrics.to_prometheus(), 'text/plain; version=0.0.4')
+        elif parts.path in ('/', '/status'):
+            pairs, results = service.snapshot()
+            self._send(200, {'cycle': service.cycle, 'updated': service.updated, 'stores': len(pairs),
+                             'urls': sum(len(pair['urls']) for pair in pairs.values()), 'results': len(results)})
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        service = self.server.service
+        path = urlsplit(self.path).path
+        if path == '/refresh':
+            service.refresh.set()
+            self._send(202, {'refresh': 'scheduled'})
+        elif path == '/export':
+            self._send(200, service.export())
+        else:
+            self._send(404, {'error': 'not found'})
+
+def close_hedging():
+    """
+    Итог запасных запросов (--hedge); проигравшие запросы в hedge_executor не дожидаются.
+    Политика и пул сбрасываются, чтобы следующий запуск без --hedge не пошёл в закрытый пул.
+    """
+    global hedge_policy, hedge_executor
+    if hedge_policy is None:
+        return
+    if hedge_executor is not None:
+        hedge_executor.shutdown(wait=False, cancel_futures=True)
+        hedge_executor = None
+    state = hedge_policy.snapshot()
+    hedge_policy = None
+    share = state['hedges'] / state['requests'] if state['requests'] else 0
+    logging.info(f"{Fore.CYAN}Hedging: {state['hedges']} hedged requests ({share:.1%} of {state['requests']}), "
+                 f"{state['wins']} answered first, last delay {state['delay']}s{Style.RESET_ALL}")
+
+def open_url_history(args):
+    """
+    UrlHistory из --url-history или None при --no-url-history и ошибке SQLite.
+    """
+    if args.no_url_history:
+        return None
+    try:
+        url_history = UrlHistory(args.url_history)
+    except sqlite3.Error as e:
+        logging.warning(f"{Fore.YELLOW}URL history disabled: {e}{Style.RESET_ALL}")
+        return None
+    logging.info(f"{Fore.GREEN}URL history '{args.url_history}': {len(url_history)} known URLs.{Style.RESET_ALL}")
+    return url_history
+
+def run_daemon_cycle(service, async_engine, max_concurrency, upload_snapshot, url_history=None):
+    """
+    Один цикл перепроверки всех ссылок: результаты сразу видны через HTTP,
+    файл загрузки магазина пишется, как только готовы все его ссылки.
+    """
+    args = service.args
+    if result_cache is not None:
+        # Из кэша — только результаты этого цикла (одинаковые ссылки разных магазинов)
+        result_cache.fresh_since = time.time()
+    pairs, _ = service.snapshot()
+    tasks, finish = schedule_tasks([item for pair in pairs.values() for item in pair['urls']], url_history, args)
+    remaining = {idx: len(pair['urls']) for idx, pair in pairs.items()}
+    history = RunHistory(time.strftime('%Y%m%d-%H%M%S'))
+    progress = ProgressReporter(sum(remaining.values()), len(pairs), 0, args.progress_interval, enabled=not args.no_progress)
+    progress.start()
+    processed = errors = pairs_done = 0
+    completed = finish(async_engine.run(tasks) if async_engine else run_threaded(tasks, max_concurrency))
+    for task, url, result in completed:
+        idx = task.pair_idx
+        pair = pairs[idx]
+        latency = None if result.status in (FetchStatus.CACHED, FetchStatus.DEFERRED) else result.latency
+        history.add(pair['store_name'], task.sku, url, result.count if result.ok else None, result.status.value,
+                    latency, result.proxy)
+        if result.ok:
+            service.record(idx, task.row, result.count)
+            if url_history is not None and result.status not in (FetchStatus.CACHED, FetchStatus.DEFERRED):
+                url_history.record(canonicalize_url(url), result.count)
+        else:
+            errors += 1
+        processed += 1
+        remaining[idx] -= 1
+        if not remaining[idx]:
+            pairs_done += 1
+            if not args.no_upload:
+                _, results = service.snapshot()
+                with service.write_lock:
+                    write_store_upload(pairs, idx, results, args.upload_dir, upload_snapshot)
+        progress.update(processed, errors, pairs_done)
+    progress.stop()
+    if url_history is not None:
+        url_history.flush()
+
+    service.cycle += 1
+    service.updated = time.strftime('%Y-%m-%dT%H:%M:%S')
+    if not args.no_excel:
+        _, results = service.snapshot()
+        with service.write_lock:
+            save_workbook_with_retries(lambda: build_output_workbook(pairs, results), 'StockReady.xlsx', retries=1, delay=0)
+    if not args.no_history:
+        try:
+            history.save(args.history_dir)
+        except (ImportError, OSError, ValueError) as e:
+            logging.warning(f"{Fore.YELLOW}Run history not saved: {e}{Style.RESET_ALL}")
+    logging.info(f"{Fore.CYAN}Cycle {service.cycle} completed: {processed} URLs, {errors} errors.{Style.RESET_ALL}")
+
+def run_daemon(args, store_names, links, async_engine, max_concurrency):
+    """
+    Режим --daemon: прокси, пулы соединений, кэш и ссылки остаются в памяти между циклами.
+    Цикл повторяется раз в --refresh-interval секунд, сразу после изменения Stock_All.xlsx
+    или по POST /refresh. Текущие результаты отдаёт HTTP-сервер на 127.0.0.1:--daemon-port.
+    """
+    service = StockService(args)
+    service.load(store_names, links)
+    try:
+        server = ThreadingHTTPServer((args.daemon_host, args.daemon_port), StockRequestHandler)
+    except OSError as e:
+        logging.error(f"{Fore.RED}Could not listen on {args.daemon_host}:{args.daemon_port}: {e}{Style.RESET_ALL}")
+        return
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, name="stock-http", daemon=True).start()
+    logging.info(f"{Fore.GREEN}Serving stock on http://{args.daemon_host}:{args.daemon_port}/ "
+                 f"(refresh every {args.refresh_interval}s). Press Ctrl+C to stop.{Style.RESET_ALL}")
+
+    metrics_stop = threading.Event()
+    metrics_thread = None
+    if args.metrics_file:
+        metrics_thread = threading.Thread(target=export_metrics, args=(args.metrics_file, args.metrics_interval, metrics_stop),
+                                          daemon=True)
+        metrics_thread.start()
+    upload_snapshot = open_upload_snapshot(args.upload_snapshot, args.delta, args.full_every) if not args.no_upload else None
+    url_history = open_url_history(args)
+    try:
+        while True:
+            started = time.monotonic()
+            service.refresh.clear()
+            run_daemon_cycle(service, async_engine, max_concurrency, upload_snapshot, url_history)
+            if args.max_cycles and service.cycle >= args.max_cycles:
+                break
+            # Ожидание следующего цикла с проверкой изменений Stock_All.xlsx
+            while time.monotonic() - started < args.refresh_interval:
+                wait = min(WATCH_INTERVAL, args.refresh_interval - (time.monotonic() - started))
+                if service.refresh.wait(max(wait, 0)):
+                    break
+                if service.changed():
+                    logging.info(f"{Fore.YELLOW}'{service.path}' changed, reloading.{Style.RESET_ALL}")
+                    break
+            if service.changed():
+                try:
+                    service.load()
+                except Exception as e:
+                    logging.error(f"{Fore.RED}Error reloading '{service.path}', keeping the previous URLs: {e}{Style.RESET_ALL}")
+    except KeyboardInterrupt:
+        logging.info(f"{Fore.YELLOW}Stopping daemon...{Style.RESET_ALL}")
+    finally:
+        server.shutdown()
+        server.server_close()
+        if upload_snapshot is not None:
+            upload_snapshot.close()
+        if url_history is not None:
+            url_history.close()
+        if metrics_thread:
+            metrics_stop.set()
+            metrics_thread.join()
+
+def main(args=None):
+    global proxy_scheduler, session_pool, fast_extract, result_cache, rate_limiter, concurrency, retry_budget, trace_log
+    global rewrite_urls, hedge_policy, hedge_executor
+    if args is None:
+        args = parse_args([])
+    if args.history_report:
+        history_report(args.history_dir, args.history_top)
+        return
+    fast_extract = args.fast_extract
+    rewrite_urls = not args.no_rewrite
+    retry_budget = args.retries
+    error_count = 0
+    global_processed = 0
+
+    try:
+        start = time.perf_counter()
+        store_names, links = load_links(STOCK_ALL_FILE)
+        metrics.inc('stock_stage_seconds_total', time.perf_counter() - start, stage='load')
+        logging.info(f"{Fore.GREEN}Loaded 'Stock_All.xlsx' successfully.{Style.RESET_ALL}")
+    except Exception as e:
+        logging.error(f"{Fore.RED}Error loading Excel file: {e}{Style.RESET_ALL}")
+        return
+
+    # Сборка StockReady.xlsx из журналов шардов: после --merge или после своих --shards процессов
+    if args.merge or (args.shards > 1 and args.shard_index is None):
+        shard_files = args.merge or run_sharded(args)
+        pairs = build_pairs(store_names, links)
+        results = merge_shard_outputs(shard_files, pairs)
+        total_links = sum(len(pair['urls']) for pair in pairs.values())
+        error_count = total_links - len(results)
+        logging.info(f"{Fore.GREEN}Merged {len(results)} results from {len(shard_files)} shard files, {error_count} URLs without a result.{Style.RESET_ALL}")
+        if not args.no_upload:
+            upload_snapshot = open_upload_snapshot(args.upload_snapshot, args.delta, args.full_every)
+            for idx in pairs:
+                write_store_upload(pairs, idx, results, args.upload_dir, upload_snapshot)
+            if upload_snapshot is not None:
+                upload_snapshot.close()
+        if not args.no_excel:
+            write_stock_ready(pairs, results)
+        report_results(pd.Series(list(results.values()), dtype='Int64'), error_count)
+        return
+
+    # Один шард: только свои ссылки, своя часть прокси и свои файлы журнала, метрик и трассировки
+    sharded = args.shard_index is not None
+    if sharded:
+        links = [[item for item in urls if shard_of(idx, item.row, args.shard_count, args.shard_by) == args.shard_index]
+                 for idx, urls in enumerate(links, start=1)]
+        # Свой журнал у каждого шарда, в том числе при --journal: run_sharded ищет их по тому же имени
+        args.journal = shard_path(args.journal, args.shard_index, args.shard_count)
+        if args.metrics_file:
+            args.metrics_file = shard_path(args.metrics_file, args.shard_index, args.shard_count)
+        if args.trace_log:
+            args.trace_log = shard_path(args.trace_log, args.shard_index, args.shard_count)
+        logging.info(f"{Fore.GREEN}Shard {args.shard_index}/{args.shard_count} (by {args.shard_by}), results go to '{args.journal}'.{Style.RESET_ALL}")
+
+    # Подсчёт общего количества ссылок
+    total_links = sum(len(urls) for urls in links)
+    logging.info(f"{Fore.GREEN}Total URLs to process: {total_links}{Style.RESET_ALL}")
+
+    proxies = load_proxies(args.proxies_file)
+    if sharded and args.proxies_file == PROXIES_FILE and len(proxies) >= args.shard_count:
+        # Общий proxies.txt делится между шардами, чтобы они не делили одни и те же прокси
+        proxies = proxies[args.shard_index - 1::args.shard_count]
+        logging.info(f"{Fore.GREEN}Using {len(proxies)} proxies of this shard.{Style.RESET_ALL}")
+    # Без прокси все потоки работают через одну «прямую» запись пула
+    # Число одновременных запросов подстраивается между --min-concurrency и --max-concurrency
+    max_concurrency = args.max_concurrency or (args.async_concurrency if args.engine == 'async' else CONCURRENCY_MAX)
+    concurrency = ConcurrencyController(args.concurrency, args.min_concurrency, max_concurrency,
+                                        args.latency_target, adaptive=not args.fixed_concurrency)
+    rate_limiter = ProxyRateLimiter(args.proxy_rate, args.proxy_burst)
+    hedge_policy = HedgePolicy(args.hedge_percentile, args.hedge_budget) if args.hedge else None
+    hedge_executor = None
+    if args.hedge:
+        # Основной и запасной запрос идут в своих потоках, пока рабочий поток ждёт первый ответ.
+        # Нужно и при --engine async: --verify-rewrite всегда работает в потоках
+        hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * max_concurrency,
+                                                               thread_name_prefix='hedge')
+    session_pool = SessionPool(args.sessions_per_proxy if proxies else max_concurrency, args.session_idle_timeout)
+    # Свежие результаты прошлых проверок берутся из файла, проверяются только остальные
+    check_cache = ProxyCheckCache(args.proxy_check_cache, args.proxy_check_ttl)
+    valid_proxies = []
+    invalid_proxies = []
+    unchecked_proxies = []
+    for proxy in proxies:
+        ok = check_cache.get(proxy)
+        if ok is None:
+            unchecked_proxies.append(proxy)
+        else:
+            (valid_proxies if ok else invalid_proxies).append(proxy)
+    if proxies:
+        logging.info(f"{Fore.GREEN}Proxy check cache: {len(proxies) - len(unchecked_proxies)} of {len(proxies)} proxies known.{Style.RESET_ALL}")
+
+    proxy_check_thread = None
+    if unchecked_proxies and args.lazy_proxy_check:
+        # Непроверенные прокси сразу идут в работу, плохие выводятся по мере проверки
+        proxy_scheduler = ProxyScheduler(valid_proxies + unchecked_proxies, breaker_threshold=args.breaker_threshold,
+                                         cooldown=args.breaker_cooldown)
+
+        def on_result(proxy, ok):
+            if not ok:
+                logging.warning(f"{Fore.YELLOW}Proxy {proxy['http']} failed the check and was disabled{Style.RESET_ALL}")
+                proxy_scheduler.disable(proxy)
+
+        proxy_check_thread = threading.Thread(target=check_proxies, args=(unchecked_proxies, check_cache, on_result),
+                                              daemon=True)
+        proxy_check_thread.start()
+        logging.info(f"{Fore.GREEN}Checking {len(unchecked_proxies)} proxies in the background.{Style.RESET_ALL}")
+    else:
+        if unchecked_proxies:
+            checked_valid, checked_invalid = check_proxies(unchecked_proxies, check_cache)
+            valid_proxies += checked_valid
+            invalid_proxies += checked_invalid
+        # Упрощённый вывод проверки прокси
+        logging.info(f"{Fore.GREEN}All proxies have been checked.{Style.RESET_ALL}")
+        logging.info(f"{Fore.GREEN}Valid proxies: {len(valid_proxies)}{Style.RESET_ALL}")
+        if invalid_proxies:
+            logging.warning(f"{Fore.YELLOW}Invalid proxies: {len(invalid_proxies)}{Style.RESET_ALL}")
+            for proxy in invalid_proxies:
+                logging.warning(f" - Proxy {proxy['http']}{Style.RESET_ALL}")
+
+        if not valid_proxies and proxies:
+            logging.error(f"{Fore.RED}No valid proxies available. Exiting.{Style.RESET_ALL}")
+            return
+        proxy_scheduler = ProxyScheduler(valid_proxies, breaker_threshold=args.breaker_threshold,
+                                         cooldown=args.breaker_cooldown)
+
+    if args.verify_rewrite:
+        verify_rewrite(links, args.verify_rewrite, max_concurrency)
+        session_pool.close_all()
+        return
+
+    if not args.no_cache:
+        try:
+            result_cache = ResultCache(args.cache_file, args.cache_ttl, args.cache_max_entries)
+            logging.info(f"{Fore.GREEN}Result cache '{args.cache_file}': {len(result_cache)} fresh entries (TTL {args.cache_ttl}s).{Style.RESET_ALL}")
+        except sqlite3.Error as e:
+            logging.warning(f"{Fore.YELLOW}Result cache disabled: {e}{Style.RESET_ALL}")
+
+    # Асинхронный движок создаётся один раз и живёт до конца работы
+    async_engine = None
+    if args.engine == 'async':
+        try:
+            async_engine = AsyncFetchEngine(args.async_concurrency, args.per_proxy_limit, args.session_idle_timeout)
+        except RuntimeError as e:
+            logging.error(f"{Fore.RED}{e}{Style.RESET_ALL}")
+            return
+        logging.info(f"{Fore.GREEN}Using async engine: up to {args.async_concurrency} concurrent requests, {args.per_proxy_limit} per proxy.{Style.RESET_ALL}")
+
+    # Каждый запрос может писаться в журнал, в том числе в режиме службы
+    if args.trace_log:
+        try:
+            trace_log = TraceLog(args.trace_log)
+        except OSError as e:
+            logging.warning(f"{Fore.YELLOW}Trace log disabled: {e}{Style.RESET_ALL}")
+
+    # Режим службы: всё созданное выше живёт между циклами перепроверки
+    if args.daemon:
+        run_daemon(args, store_names, links, async_engine, max_concurrency)
+        if async_engine:
+            async_engine.close()
+        close_hedging()
+        if trace_log is not None:
+            trace_log.close()
+            trace_log = None
+        if proxy_check_thread:
+            proxy_check_thread.join()
+        session_pool.close_all()
+        if result_cache is not None:
+            result_cache.close()
+            result_cache = None
+        return
+
     try:
-        subprocess.run(["python", "uploadFileCreation.py"], check=True)
-        logging.info(f"{Fore.GREEN}uploadFileCreation.py executed successfully.{Style.RESET_ALL}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"{Fore.RED}Error executing uploadFileCreation.py: {e}{Style.RESET_ALL}")
-    except FileNotFoundError:
-        logging.error(f"{Fore.RED}uploadFileCreation.py not found. Please ensure the script exists in the current directory.{Style.RESET_ALL}")
+        journal = RunJournal(args.journal, resume=args.resume)
+    except OSError as e:
+        logging.error(f"{Fore.RED}Error opening journal '{args.journal}': {e}{Style.RESET_ALL}")
+        return
+    if args.resume:
+        logging.info(f"{Fore.GREEN}Resuming: {len(journal.completed)} results found in '{args.journal}'.{Style.RESET_ALL}")
+
+    # Сбор ссылок всех пар столбцов в одну общую очередь задач
+    pairs = build_pairs(store_names, links)
+    del links
+
+    # Прокси выбирает proxy_scheduler в момент запроса.
+    # Результаты хранятся по ключу (pair_idx, row), поэтому одинаковые ссылки в разных строках не путаются
+    results = ResultStore(pairs)
+    history = RunHistory(args.run_id)
+    resumed = 0
+    pairs_done = 0
+    for idx, pair in pairs.items():
+        for item in pair['urls']:
+            # При --resume ссылки, уже записанные в журнал, не загружаются повторно
+            done = journal.completed.get((idx, item.row))
+            if done and done[0] == item.url:
+                results[(idx, item.row)] = done[1]
+                history.add(pair['store_name'], item.sku, item.url, done[1], 'journal')
+                pair['processed'] += 1
+                resumed += 1
+        if pair['processed'] == len(pair['urls']):
+            pairs_done += 1
+    journal.completed.clear()
+    global_processed = resumed
+    if resumed:
+        logging.info(f"{Fore.GREEN}Restored {resumed} results from the journal, {total_links - resumed} URLs left to process.{Style.RESET_ALL}")
+    # Задачи — сами LinkRecord: сначала новые и устаревшие, затем самые изменчивые (UrlHistory),
+    # сверх --budget-requests/--budget-seconds остаются последние известные значения
+    url_history = open_url_history(args)
+    pending = [item for pair in pairs.values() for item in pair['urls'] if (item.pair_idx, item.row) not in results]
+    tasks, finish = schedule_tasks(pending, url_history, args)
+    del pending
+    deferred_count = 0
+
+    # Файл загрузки магазина пишется, как только готовы все его ссылки (шард пишет только свой журнал)
+    upload = not (args.no_upload or sharded)
+    upload_snapshot = open_upload_snapshot(args.upload_snapshot, args.delta, args.full_every) if upload else None
+    if upload:
+        for idx, pair in pairs.items():
+            if pair['processed'] == len(pair['urls']):
+                write_store_upload(pairs, idx, results, args.upload_dir, upload_snapshot)
+
+    # Метрики выгружаются в файл во время работы
+    metrics_stop = threading.Event()
+    metrics_thread = None
+    if args.metrics_file:
+        metrics_thread = threading.Thread(target=export_metrics, args=(args.metrics_file, args.metrics_interval, metrics_stop),
+                                          daemon=True)
+        metrics_thread.start()
+
+    # Общий прогресс обработки всех ссылок выводится в отдельном потоке
+    progress = ProgressReporter(total_links, len(pairs), resumed, args.progress_interval, enabled=not args.no_progress)
+    progress.start()
+
+    # Один пул (или один асинхронный движок) на все пары: без простоя на «хвосте» каждой пары
+    if async_engine:
+        completed = finish(async_engine.run(tasks))
+    else:
+        completed = finish(run_threaded(tasks, max_concurrency))
+
+    for task, url, result in completed:
+        idx = task.pair_idx
+        pair = pairs[idx]
+        # У результата из кэша и отложенной ссылки нет своей задержки
+        latency = None if result.status in (FetchStatus.CACHED, FetchStatus.DEFERRED) else result.latency
+        history.add(pair['store_name'], task.sku, url, result.count if result.ok else None, result.status.value,
+                    latency, result.proxy)
+        if not result.ok:
+            # Повторы через другие прокси уже исчерпаны в worker
+            error_count += 1
+        else:
+            results[(idx, task.row)] = result.count
+            # Отложенные тоже в журнале: из него собираются шарды при --merge
+            journal.record(idx, task.row, url, result.count)
+            if result.status is FetchStatus.DEFERRED:
+                deferred_count += 1
+            elif url_history is not None and result.status is not FetchStatus.CACHED:
+                url_history.record(canonicalize_url(url), result.count)
+        pair['processed'] += 1
+        global_processed += 1
+
+        if pair['processed'] == len(pair['urls']):
+            pairs_done += 1
+            progress.log(f"{Fore.GREEN}Pair {idx} ({pair['columns']}) completed.{Style.RESET_ALL}")
+            if upload:
+                write_store_upload(pairs, idx, results, args.upload_dir, upload_snapshot)
+        progress.update(global_processed, error_count, pairs_done)
+    progress.stop()
+
+    if async_engine:
+        async_engine.close()
+    close_hedging()
+    if proxy_check_thread:
+        proxy_check_thread.join()
+    state = concurrency.snapshot()
+    logging.info(f"{Fore.CYAN}Concurrency: final limit {state['limit']}, latency {state['latency']}s, "
+                 f"throttled {state['throttled']}, cut back {state['decreases']} times{Style.RESET_ALL}")
+    # Итоговое состояние прокси
+    for row in proxy_scheduler.snapshot():
+        logging.info(f"{Fore.CYAN}Proxy {row['proxy']}: state {row['state']}, score {row['score']}, "
+                     f"latency {row['latency']}s, success {row['success_rate']:.0%}, "
+                     f"errors {row['errors']}/{row['requests']}{Style.RESET_ALL}")
+    session_pool.close_all()
+    journal.close()
+    if result_cache is not None:
+        result_cache.close()
+        result_cache = None
+    if url_history is not None:
+        url_history.close()
+    if deferred_count:
+        logging.info(f"{Fore.YELLOW}{deferred_count} stable URLs deferred by the budget, their last known values are used "
+                     f"(none older than {args.max_staleness}s).{Style.RESET_ALL}")
+
+    if error_count:
+        logging.warning(f"{Fore.RED}{error_count} URLs failed (permanent errors or {retry_budget} retries used up).{Style.RESET_ALL}")
+    else:
+        logging.info(f"{Fore.GREEN}All URLs have been processed without errors.{Style.RESET_ALL}")
+
+    # Единственная запись StockReady.xlsx: все результаты уже в памяти (шард пишет только свой журнал)
+    if not (sharded or args.no_excel):
+        write_stock_ready(pairs, results)
+    if trace_log is not None:
+        trace_log.close()
+        trace_log = None
+    if not args.no_history:
+        # История каждого шарда — отдельный файл с общим run_id
+        name = f"run_{args.run_id}.parquet"
+        if sharded:
+            name = shard_path(name, args.shard_index, args.shard_count)
+        try:
+            path = history.save(args.history_dir, name)
+            logging.info(f"{Fore.GREEN}Run history: {len(history)} rows appended to '{path}'.{Style.RESET_ALL}")
+        except (ImportError, OSError, ValueError) as e:
+            logging.warning(f"{Fore.YELLOW}Run history not saved: {e}{Style.RESET_ALL}")
+    if metrics_thread:
+        metrics_stop.set()
+        metrics_thread.join()
+        logging.info(f"{Fore.GREEN}Metrics written to '{args.metrics_file}'.{Style.RESET_ALL}")
+    if sharded:
+        logging.info(f"{Fore.GREEN}Shard {args.shard_index}/{args.shard_count} completed: {len(results)} results in '{args.journal}'. "
+                     f"Merge shard files with --merge.{Style.RESET_ALL}")
+        return
+    if upload_snapshot is not None:
+        upload_snapshot.close()
+    if upload:
+        logging.info(f"{Fore.CYAN}All upload files have been created in the '{args.upload_dir}' directory.{Style.RESET_ALL}")
+    report_results(history.frame()['stock'], error_count)
+
+def parse_args(argv=None):
+    """
+    Разбор аргументов командной строки.
+    """
+    parser = argparse.ArgumentParser(description="Check eBay stock for ParserLinks from Stock_All.xlsx")
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help="Fetch engine: 'threads' (ThreadPoolExecutor) or 'async' (aiohttp)")
+    parser.add_argument('--async-concurrency', type=int, default=ASYNC_MAX_CONCURRENCY,
+                        help='Maximum concurrent requests for the async engine')
+    parser.add_argument('--per-proxy-limit', type=int, default=ASYNC_PER_PROXY_LIMIT,
+                        help='Maximum open connections per proxy for the async engine')
+    parser.add_argument('--sessions-per-proxy', type=int, default=SESSIONS_PER_PROXY,
+                        help='Number of persistent keep-alive sessions kept per proxy')
+    parser.add_argument('--session-idle-timeout', type=int, default=SESSION_IDLE_TIMEOUT,
+                        help='Seconds after which an idle session or connection is closed')
+    parser.add_argument('--breaker-threshold', type=int, default=PROXY_BREAKER_THRESHOLD,
+                        help='Consecutive errors after which a proxy is paused')
+    parser.add_argument('--breaker-cooldown', type=int, default=PROXY_BREAKER_COOLDOWN,
+                        help='Seconds a paused proxy waits before a probe request')
+    parser.add_argument('--concurrency', type=int, default=MAX_THREADS,
+                        help='Initial number of concurrent requests')
+    parser.add_argument('--min-concurrency', type=int, default=CONCURRENCY_MIN,
+                        help='Lower bound for adaptive concurrency')
+    parser.add_argument('--max-concurrency', type=int, default=None,
+                        help=f'Upper bound for adaptive concurrency (default {CONCURRENCY_MAX}, '
+                             f'or --async-concurrency for the async engine)')
+    parser.add_argument('--latency-target', type=float, default=CONCURRENCY_LATENCY_TARGET,
+                        help='Concurrency only grows while average latency stays below this many seconds')
+    parser.add_argument('--fixed-concurrency', action='store_true',
+                        help='Keep concurrency at --concurrency instead of adapting it')
+    parser.add_argument('--proxy-rate', type=float, default=PROXY_RATE,
+                        help='Requests per second allowed through each proxy (0 disables pacing)')
+    parser.add_argument('--proxy-burst', type=int, default=PROXY_BURST,
+                        help='Requests a proxy may send back to back before pacing applies')
+    parser.add_argument('--retries', type=int, default=RETRY_BUDGET,
+                        help='Immediate retries through a different proxy for a failed URL')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Send a second request through another proxy when a response is slower than '
+                             '--hedge-percentile of recent latencies; the first answer wins')
+    parser.add_argument('--hedge-percentile', type=float, default=HEDGE_PERCENTILE,
+                        help='Latency percentile after which a request is hedged')
+    parser.add_argument('--hedge-budget', type=float, default=HEDGE_BUDGET,
+                        help='Maximum hedged requests as a share of all requests')
+    parser.add_argument('--proxies-file', type=str, default=PROXIES_FILE,
+                        help='File with proxies, one ip:port:user:pwd per line')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the URLs into this many shards and run each in its own process')
+    parser.add_argument('--shard-by', choices=['store', 'hash'], default='hash',
+                        help="Assign URLs to shards by store (column pair) or by a hash of the row")
+    parser.add_argument('--shard-index', type=int, default=None,
+                        help='Run only this shard (1-based), e.g. on another machine; needs --shard-count')
+    parser.add_argument('--shard-count', type=int, default=None,
+                        help='Total number of shards for --shard-index')
+    parser.add_argument('--merge', nargs='+', default=None, metavar='SHARD_FILE',
+                        help='Build StockReady.xlsx from shard journal files instead of fetching')
+    parser.add_argument('--no-upload', action='store_true',
+                        help='Do not write upload files')
+    parser.add_argument('--upload-dir', type=str, default=UPLOAD_DIR,
+                        help='Directory for the per-store upload files')
+    parser.add_argument('--delta', action='store_true',
+                        help='Upload files contain only SKUs whose quantity changed since the last upload')
+    parser.add_argument('--full-every', type=int, default=0,
+                        help='With --delta, write a full upload file every N runs per store (0: only the first run)')
+    parser.add_argument('--upload-snapshot', type=str, default=SNAPSHOT_FILE,
+                        help='SQLite file with the last uploaded quantity per store and SKU for --delta '
+                             '(full writes update it too once it exists)')
+    parser.add_argument('--no-excel', action='store_true',
+                        help='Do not save StockReady.xlsx (upload files are still written)')
+    parser.add_argument('--run-id', type=str, default=time.strftime('%Y%m%d-%H%M%S'),
+                        help='Run identifier in the run history (default: start time); shards of one run share it')
+    parser.add_argument('--history-dir', type=str, default=HISTORY_DIR,
+                        help='Directory with one Parquet file of results per run (needs pyarrow)')
+    parser.add_argument('--no-history', action='store_true',
+                        help='Do not append this run to the run history')
+    parser.add_argument('--history-report', action='store_true',
+                        help='Print run, listing and proxy trends from the run history and exit')
+    parser.add_argument('--history-top', type=int, default=HISTORY_TOP,
+                        help='Rows per table in --history-report')
+    parser.add_argument('--no-progress', action='store_true',
+                        help='Do not print the progress line')
+    parser.add_argument('--progress-interval', type=float, default=PROGRESS_INTERVAL,
+                        help='Seconds between progress line refreshes')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='Write metrics during the run: JSON if the name ends with .json, else Prometheus text')
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL,
+                        help='Seconds between metrics file updates')
+    parser.add_argument('--trace-log', type=str, default=None,
+                        help='JSONL file with one line per request attempt')
+    parser.add_argument('--proxy-check-cache', type=str, default=PROXY_CHECK_CACHE_FILE,
+                        help='JSON file with recent proxy check results')
+    parser.add_argument('--proxy-check-ttl', type=int, default=PROXY_CHECK_TTL,
+                        help='Seconds a proxy check result stays fresh (0 re-checks every proxy)')
+    parser.add_argument('--lazy-proxy-check', action='store_true',
+                        help='Start fetching at once and check unknown proxies in the background')
+    parser.add_argument('--fast-extract', action='store_true',
+                        help='Stream each page and stop reading once the result count heading is found '
+                             '(falls back to a full lxml parse)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running: re-check all URLs every --refresh-interval seconds and serve results over HTTP')
+    parser.add_argument('--daemon-host', type=str, default='127.0.0.1',
+                        help='Address the --daemon HTTP server listens on')
+    parser.add_argument('--daemon-port', type=int, default=DAEMON_PORT,
+                        help='Port of the --daemon HTTP server')
+    parser.add_argument('--refresh-interval', type=int, default=REFRESH_INTERVAL,
+                        help='Seconds from the start of one --daemon cycle to the next (every cycle re-fetches; '
+                             'the cache only serves URLs already fetched in the same cycle)')
+    parser.add_argument('--max-cycles', type=int, default=0,
+                        help='Stop the daemon after this many cycles (0: run until interrupted)')
+    parser.add_argument('--no-rewrite', action='store_true',
+                        help='Fetch ParserLinks as written instead of the minimal search query')
+    parser.add_argument('--verify-rewrite', type=int, default=0, metavar='N',
+                        help='Fetch N sample URLs both as written and rewritten, report count mismatches and exit')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always fetch every URL, ignoring the persistent result cache')
+    parser.add_argument('--cache-file', type=str, default=CACHE_FILE,
+                        help='SQLite file for the persistent result cache')
+    parser.add_argument('--cache-ttl', type=int, default=CACHE_TTL,
+                        help='Seconds a cached result stays fresh')
+    parser.add_argument('--cache-max-entries', type=int, default=CACHE_MAX_ENTRIES,
+                        help='Maximum number of cached results; oldest are evicted first')
+    parser.add_argument('--url-history', type=str, default=URL_HISTORY_FILE,
+                        help='SQLite file with the last value and change frequency of every URL, used to order fetches')
+    parser.add_argument('--no-url-history', action='store_true',
+                        help='Fetch URLs in file order and do not update the URL history')
+    parser.add_argument('--budget-requests', type=int, default=0,
+                        help='Fetch at most this many URLs, most volatile first; the rest keep their last known value '
+                             '(0: no limit; new URLs and URLs older than --max-staleness are always fetched)')
+    parser.add_argument('--budget-seconds', type=float, default=0,
+                        help='Stop starting optional fetches after this many seconds (0: no limit)')
+    parser.add_argument('--max-staleness', type=int, default=MAX_STALENESS,
+                        help='Seconds after which a URL is fetched regardless of the budget')
+    parser.add_argument('--journal', type=str, default=JOURNAL_FILE,
+                        help='Append-only journal of completed URLs used by --resume')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip URLs already recorded in the journal and rebuild StockReady.xlsx from it')
+    args = parser.parse_args(argv)
+    if (args.shard_index is None) != (args.shard_count is None):
+        parser.error('--shard-index and --shard-count must be used together')
+    if args.shard_index is not None and not 1 <= args.shard_index <= args.shard_count:
+        parser.error('--shard-index must be between 1 and --shard-count')
+    if args.daemon and (args.shards > 1 or args.shard_index is not None or args.merge or args.resume):
+        parser.error('--daemon cannot be combined with --shards, --shard-index, --merge or --resume')
+    if args.no_url_history and (args.budget_requests or args.budget_seconds):
+        parser.error('--budget-requests and --budget-seconds need the URL history (drop --no-url-history)')
+    return args
 
 if __name__ == "__main__":
-    main()
+    main(parse_args())